@@ -0,0 +1,242 @@
+# -*- coding: utf-8  -*-
+# End-to-end benchmark of lepido_hostplant_bot.py, on synthetic catalogues served by the stand-in server.
+#
+# For each scale (number of catalogue species), a synthetic catalogue and the matching Wikidata entities are
+# generated, the bot runs against the stand-in server (in a subprocess, in a fresh directory), and we measure the
+# throughput, the latencies per stage (from the run metrics), the peak memory and the requests per species.
+#
+# $ python benchmark.py --scales 1000,10000 --output results.json
+# $ python benchmark.py --scales 1000,10000 --compare baseline.json
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+from standin_server import StandinServer, StandinWorld
+
+logger = logging.getLogger(__name__)
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lepido_hostplant_bot.py')
+
+SPECIES_VALUE_ID = 'Q7432'
+GENUS_VALUE_ID = 'Q34740'
+
+DEFAULT_SCALES = (1000,)
+DEFAULT_TOLERANCE = 0.2  # Relative degradation above which a comparison is reported as a regression
+
+# Compared metrics, and whether higher is better
+COMPARED_METRICS = (('species_per_second', True), ('peak_memory_mb', False), ('requests_per_species', False))
+COMPARED_LATENCY_PERCENTILE = 'p95'
+MIN_LATENCY_DIFFERENCE = 0.005  # seconds: below this, latency differences are noise
+
+
+def letters(number: int) -> str:
+    # 0 -> 'a', 25 -> 'z', 26 -> 'ba'... (names with digits don't look like taxon names)
+    word = ''
+    while True:
+        word = chr(ord('a') + number % 26) + word
+        number = number // 26
+        if number == 0:
+            return word
+
+
+def claim(q_code: str, property_id: str, value: str, index: int = 0) -> Dict[str, Any]:
+    if value.startswith('Q') and value[1:].isdigit():
+        datavalue = {'type': 'wikibase-entityid', 'value': {'entity-type': 'item', 'numeric-id': int(value[1:]), 'id': value}}
+    else:
+        datavalue = {'type': 'string', 'value': value}
+    return {'id': f'{q_code}${property_id}-{index}', 'type': 'statement', 'rank': 'normal', 'references': [],
+            'mainsnak': {'snaktype': 'value', 'property': property_id, 'datavalue': datavalue}}
+
+
+class WorldGenerator(object):
+    # Synthetic catalogue + Wikidata entities, deterministic for a given seed.
+    #
+    # - match_rate / duplicate_rate: share of the lepidoptera found once / several times (by P5862) on Wikidata,
+    #   the others are missing
+    # - plant_match_rate / plant_duplicate_rate: same for the host plant names
+
+    def __init__(self, species_count: int, synonym_ratio: float = 0.1, host_plants_per_species: float = 3,
+                 match_rate: float = 0.85, duplicate_rate: float = 0.02, plant_match_rate: float = 0.9,
+                 plant_duplicate_rate: float = 0.01, genus_observation_ratio: float = 0.2, seed: int = 0):
+        self.species_count = species_count
+        self.synonym_ratio = synonym_ratio
+        self.host_plants_per_species = host_plants_per_species
+        self.match_rate = match_rate
+        self.duplicate_rate = duplicate_rate
+        self.plant_match_rate = plant_match_rate
+        self.plant_duplicate_rate = plant_duplicate_rate
+        self.genus_observation_ratio = genus_observation_ratio
+        self.random = random.Random(seed)
+
+        self.entities = {}  # type: Dict[str, Dict[str, Any]]
+        self.next_q_number = 1000000
+
+    def _entity(self, claims: List[Tuple[str, str]]) -> str:
+        q_code = f'Q{self.next_q_number}'
+        self.next_q_number = self.next_q_number + 1
+        entity_claims = {}  # type: Dict[str, List[Dict[str, Any]]]
+        for property_id, value in claims:
+            property_claims = entity_claims.setdefault(property_id, [])
+            property_claims.append(claim(q_code, property_id, value, len(property_claims)))
+        self.entities[q_code] = {'id': q_code, 'type': 'item', 'claims': entity_claims}
+        return q_code
+
+    def _taxon(self, name: str, rank_value_id: str, extra_claims: List[Tuple[str, str]], match_rate: float, duplicate_rate: float):
+        draw = self.random.random()
+        copies = 0 if draw >= match_rate + duplicate_rate else (2 if draw >= match_rate else 1)
+        for _ in range(copies):
+            self._entity([('P225', name), ('P105', rank_value_id)] + extra_claims)
+
+    def _plant_names(self) -> Tuple[List[str], List[str]]:
+        genera = [f'Plantgenus{letters(i)}' for i in range(max(10, self.species_count // 20))]
+        species = [f'{self.random.choice(genera)} {letters(i)}ifolia' for i in range(max(20, self.species_count // 2))]
+        for name in genera:
+            self._taxon(name, GENUS_VALUE_ID, [('P961', f'ipni-{name}')], self.plant_match_rate, self.plant_duplicate_rate)
+        for name in species:
+            self._taxon(name, SPECIES_VALUE_ID, [('P961', f'ipni-{name}')], self.plant_match_rate, self.plant_duplicate_rate)
+        return species, genera
+
+    def generate(self) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        plant_species, plant_genera = self._plant_names()
+
+        catalogue = []
+        for i in range(self.species_count):
+            species_id = i + 1
+            name = f'Lepidopterus {letters(i)}ella'
+            is_synonym = self.random.random() < self.synonym_ratio
+
+            observations = []
+            if not is_synonym:
+                self._taxon(name, SPECIES_VALUE_ID, [('P5862', str(species_id))], self.match_rate, self.duplicate_rate)
+                # Between 0 and twice the average number of host plants
+                for _ in range(self.random.randint(0, int(2 * self.host_plants_per_species))):
+                    if self.random.random() < self.genus_observation_ratio:
+                        observations.append({'observationType': 'HostPlantGenus', 'name': self.random.choice(plant_genera)})
+                    else:
+                        observations.append({'observationType': 'HostPlantSpecies', 'name': self.random.choice(plant_species)})
+
+            catalogue.append({'id': species_id, 'name': name, 'is_synonym': is_synonym, 'observations': observations})
+
+        return catalogue, self.entities
+
+
+def peak_memory_mb(rusage) -> float:
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(rusage.ru_maxrss / divisor, 1)
+
+
+def run_bot(server_url: str, mode: str, work_dir: str) -> Tuple[float, float, int]:
+    # Returns (wall time, peak memory, exit code) of a bot run
+    command = [sys.executable, BOT_PATH, mode, '--standin', server_url, '--metrics-file', 'metrics.json']
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return time.perf_counter() - start, peak_memory_mb(rusage), process.returncode
+
+
+def benchmark(species_count: int, mode: str, args) -> Dict[str, Any]:
+    catalogue, entities = WorldGenerator(species_count, synonym_ratio=args.synonym_ratio,
+                                         host_plants_per_species=args.host_plants_per_species,
+                                         match_rate=args.match_rate, duplicate_rate=args.duplicate_rate,
+                                         plant_match_rate=args.plant_match_rate,
+                                         plant_duplicate_rate=args.plant_duplicate_rate, seed=args.seed).generate()
+
+    server = StandinServer(StandinWorld(catalogue, entities, catalogue_page_size=args.page_size),
+                           latencies={'catalogue': args.latency, 'sparql': args.latency, 'api': args.latency})
+    server.start_in_thread()
+    try:
+        with tempfile.TemporaryDirectory(prefix='benchmark-') as work_dir:
+            logger.info(f'{species_count} species ({len(entities)} entities), {mode} mode...')
+            wall_time, peak_memory, exit_code = run_bot(server.url, mode, work_dir)
+            if exit_code != 0:
+                raise RuntimeError(f'The bot failed (exit code {exit_code}) on {species_count} species')
+            with open(os.path.join(work_dir, 'metrics.json')) as metrics_file:
+                metrics = json.load(metrics_file)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    requests = server.stats()
+    return {'species': species_count,
+            'mode': mode,
+            'wall_seconds': round(wall_time, 3),
+            'species_per_second': round(species_count / wall_time, 1),
+            'peak_memory_mb': peak_memory,
+            'requests': requests,
+            'requests_per_species': round(sum(count for name, count in requests.items() if name in ('catalogue', 'sparql', 'api')) / species_count, 4),
+            'latencies': {stage: {key: latency[key] for key in ('count', 'p50', 'p95')} for stage, latency in metrics['latencies'].items()},
+            'counters': metrics['counters']}
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    # Regressions of the results, compared to the baseline runs of the same scale and mode
+    baseline_runs = {(run['species'], run['mode']): run for run in baseline}
+    regressions = []
+    for run in results:
+        reference = baseline_runs.get((run['species'], run['mode']))
+        if reference is None:
+            continue
+
+        compared = [(name, run[name], reference[name], higher_is_better) for name, higher_is_better in COMPARED_METRICS]
+        for stage, latency in run['latencies'].items():
+            reference_latency = reference['latencies'].get(stage, {}).get(COMPARED_LATENCY_PERCENTILE)
+            if (latency[COMPARED_LATENCY_PERCENTILE] is not None and reference_latency is not None
+                    and abs(latency[COMPARED_LATENCY_PERCENTILE] - reference_latency) >= MIN_LATENCY_DIFFERENCE):
+                compared.append((f'{stage} {COMPARED_LATENCY_PERCENTILE}', latency[COMPARED_LATENCY_PERCENTILE],
+                                 reference['latencies'][stage][COMPARED_LATENCY_PERCENTILE], False))
+
+        for name, value, reference_value, higher_is_better in compared:
+            if not reference_value:
+                continue
+            change = (value - reference_value) / reference_value
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{run['species']} species, {run['mode']}: {name} {reference_value} -> {value} ({change:+.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark lepido_hostplant_bot.py on synthetic catalogues (against the stand-in server).")
+    parser.add_argument('--scales', default=','.join(str(scale) for scale in DEFAULT_SCALES),
+                        help="Comma-separated numbers of catalogue species")
+    parser.add_argument('--mode', choices=('run', 'plan'), default='run')
+    parser.add_argument('--synonym-ratio', type=float, default=0.1)
+    parser.add_argument('--host-plants-per-species', type=float, default=3)
+    parser.add_argument('--match-rate', type=float, default=0.85, help="Share of the lepidoptera found on Wikidata")
+    parser.add_argument('--duplicate-rate', type=float, default=0.02, help="Share of the lepidoptera found twice on Wikidata")
+    parser.add_argument('--plant-match-rate', type=float, default=0.9)
+    parser.add_argument('--plant-duplicate-rate', type=float, default=0.01)
+    parser.add_argument('--page-size', type=int, default=100, help="Number of species per catalogue page")
+    parser.add_argument('--latency', type=float, default=0, help="Latency added by the stand-in server to each request (seconds)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json', help="Results file (JSON), usable as a baseline")
+    parser.add_argument('--compare', metavar='BASELINE', help="Compare the results with this baseline, exit with 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    results = [benchmark(int(scale), args.mode, args) for scale in args.scales.split(',')]
+    for run in results:
+        latencies = ', '.join(f"{stage} p50 {latency['p50']:.3f}s p95 {latency['p95']:.3f}s" for stage, latency in sorted(run['latencies'].items()))
+        print(f"{run['species']} species: {run['wall_seconds']}s ({run['species_per_second']} species/s), "
+              f"peak memory {run['peak_memory_mb']} MB, {run['requests_per_species']} requests/species\n    {latencies}")
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    logger.info(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        sys.exit(1 if regressions else 0)
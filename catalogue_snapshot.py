@@ -0,0 +1,93 @@
+# -*- coding: utf-8  -*-
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+from catalogue_stream import SpeciesRecord
+
+
+def species_content_hash(species_data: SpeciesRecord) -> str:
+    # Only what matters for the synchronization: name, synonym status and host plants
+    content = [species_data.name, species_data.is_synonym,
+               sorted(species_data.host_plant_species), sorted(species_data.host_plant_genera)]
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+class CatalogueSnapshot(object):
+    # What the catalogue looked like the last time we synchronized it: a content hash per species id, and the
+    # HTTP validators (ETag, Last-Modified) of each page, to send conditional requests.
+    #
+    # Also the Wikidata side: the revision id of each lepidoptera item at the time we synchronized it (None if we
+    # didn't read it), and the species it was synchronized for, so items edited by others since then can be found.
+    #
+    # Pages and species are recorded only once they have been processed, so an interrupted run doesn't cause
+    # changes to be missed by the next one.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.species_hashes = {}  # type: Dict[str, str]
+        self.pages = {}  # type: Dict[str, Dict[str, Any]]
+        self.items = {}  # type: Dict[str, Dict[str, Any]]  # Q code -> {'revision': ..., 'species': [species ids]}
+
+        if os.path.exists(path):
+            with open(path) as snapshot_file:
+                data = json.load(snapshot_file)
+            self.species_hashes = data['species']
+            self.pages = data['pages']
+            self.items = data.get('items', {})  # Snapshots of older versions don't have them
+
+        self.species_items = {}  # type: Dict[str, str]  # species id -> Q code
+        for q_code, item in self.items.items():
+            for species_id in item['species']:
+                self.species_items[str(species_id)] = q_code
+
+    def conditional_headers(self, page_num: int) -> Dict[str, str]:
+        headers = {}
+        validators = self.pages.get(str(page_num), {})
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def has_more_pages(self, page_num: int) -> bool:
+        return self.pages.get(str(page_num), {}).get('has_more', True)
+
+    def changed_species(self, page_results: List[SpeciesRecord]) -> List[SpeciesRecord]:
+        return [species_data for species_data in page_results
+                if self.species_hashes.get(str(species_data.id)) != species_content_hash(species_data)]
+
+    def page_species_ids(self, page_num: int) -> List[str]:
+        return self.pages.get(str(page_num), {}).get('species', [])
+
+    def synchronized_items(self, species_ids: Iterable[Any]) -> Dict[str, List[str]]:
+        # Q code -> ids of the given species it was synchronized for
+        items = {}  # type: Dict[str, List[str]]
+        for species_id in species_ids:
+            q_code = self.species_items.get(str(species_id))
+            if q_code is not None:
+                items.setdefault(q_code, []).append(str(species_id))
+        return items
+
+    def item_revision(self, q_code: str) -> Optional[int]:
+        return self.items.get(q_code, {}).get('revision')
+
+    def record_item(self, q_code: str, revision: Optional[int], species_ids: Iterable[Any]):
+        species_ids = [str(species_id) for species_id in species_ids]
+        previous_species_ids = self.items.get(q_code, {}).get('species', [])
+        self.items[q_code] = {'revision': revision, 'species': sorted(set(previous_species_ids) | set(species_ids))}
+        for species_id in species_ids:
+            self.species_items[species_id] = q_code
+
+    def record_page(self, page_num: int, page_results: List[SpeciesRecord], has_more: bool,
+                    etag: Optional[str], last_modified: Optional[str]):
+        for species_data in page_results:
+            self.species_hashes[str(species_data.id)] = species_content_hash(species_data)
+        self.pages[str(page_num)] = {'etag': etag, 'last_modified': last_modified, 'has_more': has_more,
+                                     'species': [str(species_data.id) for species_data in page_results]}
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as snapshot_file:
+            json.dump({'species': self.species_hashes, 'pages': self.pages, 'items': self.items}, snapshot_file)
+        os.replace(self.path + '.tmp', self.path)
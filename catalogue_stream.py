@@ -0,0 +1,127 @@
+# -*- coding: utf-8  -*-
+import codecs
+import json
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+HOST_PLANT_SPECIES_OBSERVATION = 'HostPlantSpecies'
+HOST_PLANT_GENUS_OBSERVATION = 'HostPlantGenus'
+
+WHITESPACE = ' \t\n\r'
+
+
+class SpeciesRecord(object):
+    # Compact version of a species of the catalogue: only what the bot needs, built in a single pass over the
+    # observations (the full observation dicts are dropped immediately)
+    __slots__ = ('id', 'name', 'is_synonym', 'host_plant_species', 'host_plant_genera')
+
+    def __init__(self, id, name: str, is_synonym: bool, host_plant_species: Tuple[str, ...], host_plant_genera: Tuple[str, ...]):
+        self.id = id
+        self.name = name
+        self.is_synonym = is_synonym
+        self.host_plant_species = host_plant_species
+        self.host_plant_genera = host_plant_genera
+
+    @property
+    def has_host_plants(self) -> bool:
+        return bool(self.host_plant_species or self.host_plant_genera)
+
+    @classmethod
+    def from_json(cls, species_data: Dict[str, Any]) -> 'SpeciesRecord':
+        host_plant_species = []
+        host_plant_genera = []
+        for observation in species_data['observations']:
+            if observation['observationType'] == HOST_PLANT_SPECIES_OBSERVATION:
+                host_plant_species.append(observation['name'])
+            elif observation['observationType'] == HOST_PLANT_GENUS_OBSERVATION:
+                host_plant_genera.append(observation['name'])
+        return cls(species_data['id'], species_data['name'], species_data['is_synonym'],
+                   tuple(host_plant_species), tuple(host_plant_genera))
+
+
+class IncompleteJson(Exception):
+    pass
+
+
+class CataloguePageParser(object):
+    # Incremental parser for a page of the catalogue ({"page": ..., "results": [...], "hasMoreResults": ...}):
+    # the response is parsed as it's downloaded, and each element of "results" is turned into a SpeciesRecord
+    # as soon as it's complete. Only the current element is kept as text/dicts.
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+
+        self.metadata = {}  # type: Dict[str, Any]  # The other keys of the page ("page", "hasMoreResults")
+
+    def _read_more(self) -> bool:
+        if self.exhausted:
+            return False
+        # Drop what we already parsed, so the buffer doesn't grow with the page
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        try:
+            self.buffer = self.buffer + self.decoder.decode(next(self.chunks))
+        except StopIteration:
+            self.buffer = self.buffer + self.decoder.decode(b'', final=True)
+            self.exhausted = True
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position = self.position + 1
+            if self.position < len(self.buffer) or not self._read_more():
+                return
+
+    def _expect(self, characters: str) -> str:
+        self._skip_whitespace()
+        if self.position >= len(self.buffer):
+            raise IncompleteJson('Unexpected end of the catalogue page')
+        character = self.buffer[self.position]
+        if character not in characters:
+            raise ValueError(f'Unexpected character in the catalogue page: {character!r} (expected one of {characters!r})')
+        self.position = self.position + 1
+        return character
+
+    def _value(self) -> Any:
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer might be truncated
+                if end < len(self.buffer) or self.exhausted:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                pass
+            if not self._read_more():
+                raise IncompleteJson('Unexpected end of the catalogue page')
+
+    def __iter__(self) -> Iterator[SpeciesRecord]:
+        self._expect('{')
+        self._skip_whitespace()
+        if self.buffer[self.position:self.position + 1] == '}':
+            return
+
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'results':
+                self._expect('[')
+                self._skip_whitespace()
+                if self.buffer[self.position:self.position + 1] == ']':
+                    self.position = self.position + 1
+                else:
+                    while True:
+                        yield SpeciesRecord.from_json(self._value())
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.metadata[key] = self._value()
+
+            if self._expect(',}') == '}':
+                return
@@ -0,0 +1,95 @@
+# -*- coding: utf-8  -*-
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Optional, Set
+
+# Events recorded in the journal
+PAGE_DONE = 'page_done'
+SPECIES_DONE = 'species_done'
+EDIT_STARTED = 'edit_started'
+EDIT_DONE = 'edit_done'
+
+
+def edit_record_key(record: Dict[str, Any]) -> str:
+    # Identifies an edit by its content (the base revision is left out: it changes if we reload the item)
+    content = {key: value for key, value in record.items() if key != 'base_revision_id'}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CheckpointJournal(object):
+    # Append-only (JSONL) journal of the progress of a run, so an interrupted run can be resumed:
+    # completed catalogue pages, completed species and submitted edits.
+    #
+    # Edits are journaled twice: before (EDIT_STARTED) and right after (EDIT_DONE) their submission. An edit that
+    # was started but not marked as done might have been submitted or not: the caller must check the item again
+    # before resubmitting it.
+    #
+    # Without a path, the journal is only kept in memory (read-only runs). Entries can be written from several
+    # threads (the readers and the edit executor).
+
+    def __init__(self, path: Optional[str], resume: bool = False):
+        self.last_completed_page = 0
+        self.completed_species = set()  # type: Set[str]
+        self.started_edits = set()  # type: Set[str]
+        self.done_edits = set()  # type: Set[str]
+        self.lock = threading.Lock()
+
+        if path and resume and os.path.exists(path):
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # Last line might be truncated if we crashed while writing it
+                        continue
+                    self._replay(entry)
+
+        self.journal_file = open(path, 'a' if resume else 'w') if path else None
+
+    def _replay(self, entry: Dict[str, Any]):
+        event = entry['event']
+        if event == PAGE_DONE:
+            self.last_completed_page = max(self.last_completed_page, entry['page'])
+        elif event == SPECIES_DONE:
+            self.completed_species.add(entry['species_id'])
+        elif event == EDIT_STARTED:
+            self.started_edits.add(entry['key'])
+        elif event == EDIT_DONE:
+            self.done_edits.add(entry['key'])
+
+    def _write(self, entry: Dict[str, Any], sync: bool = False):
+        with self.lock:
+            self._replay(entry)
+            if self.journal_file is None:
+                return
+            self.journal_file.write(json.dumps(entry) + '\n')
+            self.journal_file.flush()
+            if sync:
+                os.fsync(self.journal_file.fileno())
+
+    def page_done(self, page: int):
+        self._write({'event': PAGE_DONE, 'page': page}, sync=True)
+
+    def species_done(self, species_id):
+        self._write({'event': SPECIES_DONE, 'species_id': str(species_id)})
+
+    def is_species_done(self, species_id) -> bool:
+        return str(species_id) in self.completed_species
+
+    def edit_started(self, key: str):
+        self._write({'event': EDIT_STARTED, 'key': key}, sync=True)
+
+    def edit_done(self, key: str):
+        self._write({'event': EDIT_DONE, 'key': key}, sync=True)
+
+    def is_edit_done(self, key: str) -> bool:
+        return key in self.done_edits
+
+    def is_edit_uncertain(self, key: str) -> bool:
+        # Started but not marked as done: we probably crashed during the submission
+        return key in self.started_edits and key not in self.done_edits
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8  -*-
+# Compact on-disk index of the parts of a Wikidata JSON dump we need: taxon names (P225) + ranks (P105),
+# lepido IDs (P5862), and the host plant claims (P2975) of the lepidoptera. With it, the whole read side of
+# the bot runs locally (see --dump-index).
+#
+# Build: $ python dump_index.py latest-all.json.bz2 dump_index.sqlite3
+import argparse
+import bz2
+import gzip
+import json
+import logging
+import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+TAXON_NAME_PROPERTY_ID = 'P225'
+TAXON_RANK_PROPERTY_ID = 'P105'
+LEPIDO_ID_PROPERTY_ID = 'P5862'
+HOST_PROPERTY_ID = 'P2975'
+
+# Properties stored for each lepidoptera, so it can be diffed without the network
+STORED_CLAIMS_PROPERTY_IDS = (HOST_PROPERTY_ID,)
+
+SQLITE_MMAP_SIZE = 1024 * 1024 * 1024
+
+
+def open_dump(path: str):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    elif path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def iter_dump_entities(path: str) -> Iterator[Dict[str, Any]]:
+    # The dumps are a JSON array with one entity per line: we parse them line by line, and only the lines that
+    # might interest us (a quick substring test is much cheaper than a JSON parsing)
+    with open_dump(path) as dump_file:
+        for line in dump_file:
+            if f'"{TAXON_NAME_PROPERTY_ID}"' not in line and f'"{LEPIDO_ID_PROPERTY_ID}"' not in line:
+                continue
+            line = line.strip().rstrip(',')
+            if line in ('[', ']', ''):
+                continue
+            yield json.loads(line)
+
+
+def truthy_values(entity: Dict[str, Any], property_id: str) -> List[str]:
+    claims = [claim for claim in (entity.get('claims') or {}).get(property_id, []) if claim.get('rank') != 'deprecated']
+    preferred = [claim for claim in claims if claim.get('rank') == 'preferred']
+
+    values = []
+    for claim in preferred or claims:
+        datavalue = claim['mainsnak'].get('datavalue')
+        if datavalue is not None:
+            value = datavalue['value']
+            values.append(value['id'] if isinstance(value, dict) else str(value))
+    return values
+
+
+class DumpIndex(object):
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS taxa (name TEXT NOT NULL, rank TEXT NOT NULL, q_code TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS taxa_name_rank ON taxa (name, rank);
+            CREATE TABLE IF NOT EXISTS lepido_ids (lepido_id TEXT NOT NULL, q_code TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS lepido_ids_lepido_id ON lepido_ids (lepido_id);
+            CREATE TABLE IF NOT EXISTS entities (q_code TEXT PRIMARY KEY, lastrevid INTEGER, claims TEXT NOT NULL);
+        ''')
+
+    def build(self, dump_path: str, progress_every: int = 100000):
+        self.connection.executescript('DELETE FROM taxa; DELETE FROM lepido_ids; DELETE FROM entities;')
+
+        count = 0
+        for entity in iter_dump_entities(dump_path):
+            q_code = entity['id']
+            ranks = truthy_values(entity, TAXON_RANK_PROPERTY_ID)
+
+            self.connection.executemany('INSERT INTO taxa (name, rank, q_code) VALUES (?, ?, ?)',
+                                        [(name, rank, q_code) for name in truthy_values(entity, TAXON_NAME_PROPERTY_ID) for rank in ranks])
+
+            lepido_ids = truthy_values(entity, LEPIDO_ID_PROPERTY_ID)
+            if lepido_ids:
+                self.connection.executemany('INSERT INTO lepido_ids (lepido_id, q_code) VALUES (?, ?)',
+                                            [(lepido_id, q_code) for lepido_id in lepido_ids])
+                claims = {property_id: entity['claims'][property_id]
+                          for property_id in STORED_CLAIMS_PROPERTY_IDS if property_id in entity['claims']}
+                self.connection.execute('INSERT OR REPLACE INTO entities (q_code, lastrevid, claims) VALUES (?, ?, ?)',
+                                        (q_code, entity.get('lastrevid'), json.dumps(claims)))
+
+            count = count + 1
+            if count % progress_every == 0:
+                logger.info(f'{count} taxa indexed...')
+                self.connection.commit()
+
+        self.connection.commit()
+        logger.info(f'Done: {count} taxa indexed.')
+
+    def lookup_taxa(self, names: Iterable[str], rank: str) -> Dict[str, List[str]]:
+        results = {name: [] for name in names}  # type: Dict[str, List[str]]
+        names = list(results)
+        for i in range(0, len(names), 500):
+            batch = names[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT name, q_code FROM taxa WHERE rank = ? AND name IN ({','.join('?' * len(batch))})", [rank] + batch)
+            for name, q_code in rows:
+                if q_code not in results[name]:
+                    results[name].append(q_code)
+        return results
+
+    def lookup_lepido_ids(self, lepido_ids: Iterable[str], rank: str) -> Dict[str, List[str]]:
+        results = {lepido_id: [] for lepido_id in lepido_ids}  # type: Dict[str, List[str]]
+        lepido_ids = list(results)
+        for i in range(0, len(lepido_ids), 500):
+            batch = lepido_ids[i:i + 500]
+            rows = self.connection.execute(
+                f"""SELECT lepido_ids.lepido_id, lepido_ids.q_code FROM lepido_ids
+                    JOIN taxa ON taxa.q_code = lepido_ids.q_code AND taxa.rank = ?
+                    WHERE lepido_ids.lepido_id IN ({','.join('?' * len(batch))})""", [rank] + batch)
+            for lepido_id, q_code in rows:
+                if q_code not in results[lepido_id]:
+                    results[lepido_id].append(q_code)
+        return results
+
+    def get_entities(self, q_codes: List[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # Same format as wbgetentities (only the stored claims)
+        for i in range(0, len(q_codes), 500):
+            batch = q_codes[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT q_code, lastrevid, claims FROM entities WHERE q_code IN ({','.join('?' * len(batch))})", batch)
+            for q_code, lastrevid, claims in rows:
+                yield q_code, {'id': q_code, 'type': 'item', 'lastrevid': lastrevid, 'claims': json.loads(claims)}
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the dump index used by the --dump-index option of the bots.")
+    parser.add_argument('dump', help="Wikidata JSON dump (latest-all.json.bz2, or a pre-filtered subset, possibly gzipped)")
+    parser.add_argument('index', help="Index file to create (SQLite)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    index = DumpIndex(args.index)
+    index.build(args.dump)
+    index.close()
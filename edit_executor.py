@@ -0,0 +1,109 @@
+# -*- coding: utf-8  -*-
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Kinds of queued tasks
+EDIT = 'edit'  # An edit: paced, retried after a maxlag error
+CALLBACK = 'callback'  # Bookkeeping to do once all previous edits are done (checkpoints, ...)
+STOP = 'stop'
+
+
+class MaxlagExceeded(Exception):
+    # Raised by an edit function when the server refused the edit because of the replication lag
+    def __init__(self, retry_after: float):
+        super().__init__(f'Server lagged, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class EditExecutor(object):
+    # The write side of the bot: a single thread submitting the edits in order, fed by a bounded queue. The readers
+    # (catalogue, SPARQL, wbgetentities) keep working while we wait on the server, and they block when the queue is
+    # full (backpressure), so we never get too far ahead of what has actually been written.
+    #
+    # The pace adapts to the maxlag feedback: after a maxlag error, the edit is retried after Retry-After and the
+    # interval between edits is doubled (up to max_interval); it's halved back (down to min_interval) after each
+    # successful edit. (With pywikibot, put_throttle and maxlag waits are done inside editEntity itself.)
+    #
+    # An exception raised by an edit stops the executor, and is re-raised in the reader thread by the next submit()
+    # or by join().
+
+    def __init__(self, queue_size: int = 100, min_interval: float = 0, max_interval: float = 60, metrics=None):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.metrics = metrics  # Optional run_metrics.RunMetrics
+
+        self.interval = min_interval
+        self.next_edit_at = 0.0
+        self.error = None  # type: Optional[BaseException]
+        self.maxlag_count = 0
+
+        self.thread = threading.Thread(target=self._run, name='edit-executor', daemon=True)
+        self.thread.start()
+
+    def _put(self, task):
+        if self.error is not None:
+            raise self.error
+        if self.metrics is not None and self.queue.full():
+            self.metrics.increment('edit_queue_full')  # Readers are waiting for the writer
+        self.queue.put(task)
+
+    def submit(self, function: Callable, *args):
+        self._put((EDIT, function, args))
+
+    def call_when_done(self, function: Callable, *args):
+        # Called (in the executor thread) once all the edits submitted before are done
+        self._put((CALLBACK, function, args))
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def _edit(self, function: Callable, args):
+        while True:
+            delay = self.next_edit_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                function(*args)
+            except MaxlagExceeded as e:
+                self.maxlag_count = self.maxlag_count + 1
+                self.interval = min(self.max_interval, max(self.interval * 2, 1))
+                logger.info(f'Server lagged, pausing edits for {e.retry_after}s (then one edit every {self.interval:.1f}s).')
+                self.next_edit_at = time.monotonic() + max(e.retry_after, self.interval)
+                continue
+
+            self.interval = max(self.min_interval, self.interval / 2)
+            self.next_edit_at = time.monotonic() + self.interval
+            return
+
+    def _run(self):
+        while True:
+            kind, function, args = self.queue.get()
+            try:
+                if kind == STOP:
+                    return
+                if self.error is None:  # After an error, the remaining tasks are dropped
+                    if kind == EDIT:
+                        self._edit(function, args)
+                    else:
+                        function(*args)
+            except BaseException as e:
+                logger.error(f'Edit executor stopped: {e!r}')
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        # Wait until everything submitted is done
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put((STOP, None, ()))
+        self.thread.join()
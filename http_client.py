@@ -0,0 +1,284 @@
+# -*- coding: utf-8  -*-
+import email.utils
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Transport modes
+MODE_LIVE = 'live'  # Just send the requests
+MODE_RECORD = 'record'  # Send the requests, and record the responses in a cassette file
+MODE_REPLAY = 'replay'  # Don't touch the network: answer with the responses of the cassette file
+MODES = (MODE_LIVE, MODE_RECORD, MODE_REPLAY)
+
+DEFAULT_TIMEOUT = 30  # seconds, for the hosts without a specific timeout
+POOL_SIZE = 10  # Connections kept alive per host (the SPARQL workers and the catalogue read-ahead share them)
+MAX_RETRIES = 3  # Retries of connection errors
+RETRY_BACKOFF_FACTOR = 0.5
+
+# Throttled or failed GETs are retried (honouring Retry-After), then raised as HttpStatusError. The callers with
+# their own retry policy (SparqlClient) get the responses as they are, with check_status=False.
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+MAX_STATUS_RETRIES = 5
+MAX_STATUS_RETRY_DELAY = 60  # seconds
+
+CIRCUIT_BREAKER_THRESHOLD = 5  # Consecutive failures after which requests to a host are paused
+CIRCUIT_BREAKER_COOLDOWN = 30  # seconds, doubled each time the host still fails after a pause
+CIRCUIT_BREAKER_MAX_COOLDOWN = 600
+
+
+class CassetteMissing(Exception):
+    # Raised in replay mode for requests that are not in the cassette
+    pass
+
+
+class HttpStatusError(Exception):
+    # An error status (4xx, or 429/5xx still there after the retries) for a request made with check_status=True
+    def __init__(self, method: str, url: str, status_code: int, text: str):
+        super().__init__(f'{method} {url} failed with HTTP {status_code}: {text[:200]}')
+        self.status_code = status_code
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After can be either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        if parsed is None:
+            return None
+        return max(0.0, parsed.timestamp() - time.time())
+
+
+def interaction_key(method: str, url: str, params: Optional[Dict[str, Any]], data: Optional[Dict[str, Any]]) -> str:
+    return json.dumps([method.upper(), url, params or {}, data or {}], sort_keys=True, default=str)
+
+
+class CircuitBreaker(object):
+    # Per host: after `threshold` consecutive failures (connection errors, HTTP 429 or 5xx), the circuit opens and
+    # requests to this host wait until the end of the cooldown. The next request is a trial: if it fails again, the
+    # circuit re-opens for twice as long.
+
+    def __init__(self, threshold: int = CIRCUIT_BREAKER_THRESHOLD, cooldown: float = CIRCUIT_BREAKER_COOLDOWN,
+                 max_cooldown: float = CIRCUIT_BREAKER_MAX_COOLDOWN):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.opened_count = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.open_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self, host: str):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.failures >= self.threshold and self.open_until <= time.monotonic():
+                logger.warning(f'{host} seems degraded ({self.failures} failures in a row), pausing requests for {self.cooldown:.0f}s.')
+                self.open_until = time.monotonic() + self.cooldown
+                self.opened_count = self.opened_count + 1
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+
+
+class ReplayedResponse(object):
+    # Minimal stand-in for requests.Response, for the recorded interactions
+
+    def __init__(self, status_code: int, headers: Dict[str, str], text: str):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size: int = 1):
+        content = self.text.encode('utf-8')
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+
+class HttpClient(object):
+    # All the HTTP traffic of the bot (catalogue, SPARQL, Wikibase reads) goes through an instance of this class,
+    # so it can be recorded once and then replayed offline and deterministically.
+    #
+    # Cassettes are JSONL files, one interaction per line. When the same request is recorded several times,
+    # the responses are replayed in the same order (the last one is repeated).
+    #
+    # Requests are sent through a single pooled session (keep-alive, compressed transfer, User-Agent), with a
+    # timeout per host, bounded retries of connection errors and of throttled/failed GETs, and a circuit breaker
+    # per host.
+
+    def __init__(self, mode: str = MODE_LIVE, cassette_path: Optional[str] = None, user_agent: Optional[str] = None,
+                 timeouts: Optional[Dict[str, float]] = None, default_timeout: float = DEFAULT_TIMEOUT,
+                 pool_size: int = POOL_SIZE, max_retries: int = MAX_RETRIES, max_status_retries: int = MAX_STATUS_RETRIES):
+        if mode != MODE_LIVE and not cassette_path:
+            raise ValueError(f'A cassette file is required in {mode} mode')
+
+        self.mode = mode
+        self.cassette_path = cassette_path
+        self.lock = threading.Lock()
+
+        self.timeouts = timeouts or {}  # type: Dict[str, float]  # host -> timeout
+        self.default_timeout = default_timeout
+        self.circuit_breakers = {}  # type: Dict[str, CircuitBreaker]
+        self.max_status_retries = max_status_retries
+
+        retry = Retry(total=max_retries, connect=max_retries, read=1, status=0, backoff_factor=RETRY_BACKOFF_FACTOR,
+                      allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+        self.requests_count = 0
+
+        self.recorded = {}  # type: Dict[str, List[Dict[str, Any]]]
+        self.replay_positions = {}  # type: Dict[str, int]
+        self.cassette_file = None
+
+        if mode == MODE_REPLAY:
+            with open(cassette_path) as cassette_file:
+                for line in cassette_file:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        self.recorded.setdefault(interaction['key'], []).append(interaction['response'])
+            logger.info(f'{sum(len(responses) for responses in self.recorded.values())} interactions loaded from {cassette_path}')
+        elif mode == MODE_RECORD:
+            self.cassette_file = open(cassette_path, 'a' if os.path.exists(cassette_path) else 'w')
+
+    def get(self, url: str, params: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None,
+            headers: Optional[Dict[str, str]] = None, stream: bool = False, check_status: bool = True):
+        return self.request('GET', url, params=params, timeout=timeout, headers=headers, stream=stream, check_status=check_status)
+
+    def post(self, url: str, data: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None, check_status: bool = True):
+        return self.request('POST', url, data=data, timeout=timeout, check_status=check_status)
+
+    def request(self, method: str, url: str, params: Optional[Dict[str, Any]] = None,
+                data: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None,
+                headers: Optional[Dict[str, str]] = None, stream: bool = False, check_status: bool = True):
+        # With stream=True, the body is only downloaded when it's read (response.iter_content()), except in
+        # record mode where it has to be saved first.
+        # With check_status=True, throttled/failed GETs are retried, and error statuses raise HttpStatusError.
+        key = interaction_key(method, url, params, data)
+
+        if self.mode == MODE_REPLAY:
+            response = self._replay(key)
+            if check_status:
+                self._check_status(method, url, response)
+            return response
+
+        response = self._send(method, url, params=params, data=data, timeout=timeout, headers=headers, stream=stream)
+        attempt = 0
+        while check_status and method == 'GET' and response.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_status_retries:
+            attempt = attempt + 1
+            delay = parse_retry_after(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = RETRY_BACKOFF_FACTOR * 2 ** attempt
+            delay = min(delay, MAX_STATUS_RETRY_DELAY)
+            logger.warning(f'{urlparse(url).netloc} returned HTTP {response.status_code}, retrying in {delay:.1f}s.')
+            response.close()
+            time.sleep(delay)
+            response = self._send(method, url, params=params, data=data, timeout=timeout, headers=headers, stream=stream)
+
+        if self.mode == MODE_RECORD:
+            interaction = {'key': key,
+                           'response': {'status_code': response.status_code,
+                                        'headers': dict(response.headers),
+                                        'text': response.text}}
+            with self.lock:
+                self.cassette_file.write(json.dumps(interaction) + '\n')
+                self.cassette_file.flush()
+
+        if check_status:
+            self._check_status(method, url, response)
+        return response
+
+    def _check_status(self, method: str, url: str, response):
+        if response.status_code >= 400:
+            raise HttpStatusError(method, url, response.status_code, response.text)
+
+    def _circuit_breaker(self, host: str) -> CircuitBreaker:
+        with self.lock:
+            if host not in self.circuit_breakers:
+                self.circuit_breakers[host] = CircuitBreaker()
+            return self.circuit_breakers[host]
+
+    def _send(self, method: str, url: str, params=None, data=None, timeout=None, headers=None, stream=False):
+        host = urlparse(url).netloc
+        if timeout is None:
+            timeout = self.timeouts.get(host, self.default_timeout)
+
+        circuit_breaker = self._circuit_breaker(host)
+        circuit_breaker.wait()
+
+        with self.lock:
+            self.requests_count = self.requests_count + 1
+        try:
+            response = self.session.request(method, url, params=params, data=data, timeout=timeout, headers=headers, stream=stream)
+        except requests.RequestException:
+            circuit_breaker.record_failure(host)
+            raise
+
+        if response.status_code == 429 or response.status_code >= 500:
+            circuit_breaker.record_failure(host)
+        else:
+            circuit_breaker.record_success()
+        return response
+
+    def connection_stats(self) -> Dict[str, Any]:
+        # Connections opened by the pools vs requests sent: the difference went through kept-alive connections
+        connections = 0
+        with self.lock:
+            pools = [self.adapter.poolmanager.pools[key] for key in self.adapter.poolmanager.pools.keys()]
+            requests_count = self.requests_count
+            circuit_breaks = sum(circuit_breaker.opened_count for circuit_breaker in self.circuit_breakers.values())
+        for pool in pools:
+            connections = connections + pool.num_connections
+        reused = max(0, requests_count - connections)
+        return {'requests': requests_count,
+                'connections': connections,
+                'reused': reused,
+                'reuse_ratio': reused / requests_count if requests_count else None,
+                'circuit_breaks': circuit_breaks}
+
+    def _replay(self, key: str) -> ReplayedResponse:
+        with self.lock:
+            responses = self.recorded.get(key)
+            if not responses:
+                raise CassetteMissing(f'No recorded response for {key}')
+
+            position = self.replay_positions.get(key, 0)
+            self.replay_positions[key] = position + 1
+            response = responses[min(position, len(responses) - 1)]
+
+        return ReplayedResponse(response['status_code'], response['headers'], response['text'])
+
+    def close(self):
+        self.session.close()
+        if self.cassette_file is not None:
+            self.cassette_file.close()
@@ -1,18 +1,43 @@
 # -*- coding: utf-8  -*-
+import argparse
+import collections
+import csv
 import functools
+import json
 import logging
+import multiprocessing
+import os
+import queue
+import re
 import sys
-import time
+import threading
 from logging import warning
-from typing import Any, Dict, List, Optional
+from typing import Any, Counter, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlparse
 
 import coloredlogs
-import requests
 import datetime
 
-sys.path.append('/Users/nicolasnoe/pywikibot'); import pywikibot
+import standin_server
+from catalogue_snapshot import CatalogueSnapshot
+from catalogue_stream import CataloguePageParser, SpeciesRecord
+from checkpoint_journal import CheckpointJournal, edit_record_key
+from dump_index import DumpIndex
+from edit_executor import EditExecutor, MaxlagExceeded
+from http_client import MODE_LIVE, MODE_REPLAY, MODES as HTTP_MODES, HttpClient
+from lookup_cache import DAY, LookupCache
+from plant_name_index import PlantNameIndex
+from run_metrics import FORMAT_JSON, FORMAT_PROMETHEUS, RunMetrics
+from run_profiler import SamplingProfiler
+from sparql_client import SparqlClient
+from taxon_disambiguation import (ANIMALIA_Q_VALUE, PLANTAE_Q_VALUE, candidates_context_query, choose_candidate,
+                                  genus_name, parse_candidates_context)
+
+sys.path.append('/Users/nicolasnoe/pywikibot')  # pywikibot itself is only imported when we write to Wikidata (see __main__)
 
 CATALOGUE_SPECIES_DETAILS_ENDPOINT = "https://projects.biodiversity.be/lepidoptera/all_species_details_json/"
+CATALOGUE_READ_AHEAD_PAGES = 3  # How many catalogue pages are fetched in the background while we process the current one
+CATALOGUE_STREAM_CHUNK_SIZE = 64 * 1024  # Catalogue pages are parsed while they are downloaded, by chunks of this size
 LOGLEVEL = 'INFO'
 
 WIKIDATA_SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
@@ -22,14 +47,72 @@ HOST_PROPERTY_ID = 'P2975'
 SPECIES_VALUE_ID = 'Q7432'
 GENUS_VALUE_ID = 'Q34740'
 
+WIKIBASE_API_ENDPOINT = 'https://www.wikidata.org/w/api.php'
+WBGETENTITIES_BATCH_SIZE = 50  # Maximum number of entities per wbgetentities call (for non-bot accounts)
+
 CATALOGUE_Q_VALUE = 'Q59799645'
 STATED_IN_PROPERTY_ID = 'P248'
 RETRIEVED_PROPERTY_ID = 'P813'
 
+EDIT_PLAN_PATH = 'edit_plan.jsonl'  # Default file for the plan and apply modes
+REPORT_PATH = 'report.json'  # Default file for the report mode (.json or .csv)
+CHECKPOINT_PATH = 'checkpoint.jsonl'  # Progress journal, used by --resume
+CATALOGUE_SNAPSHOT_PATH = 'catalogue_snapshot.json'  # State of the catalogue at the last run, used by --incremental
+
+METRICS_EXPORT_INTERVAL = 30  # seconds, see --metrics-file
+PROFILE_SAMPLING_INTERVAL = 0.005  # seconds, see --profile
+PROFILE_TOP_FUNCTIONS = 20
+
+USER_AGENT = 'WikidataBots/lepido_hostplant_bot (https://github.com/BelgianBiodiversityPlatform/WikidataBots)'
+HTTP_TIMEOUTS = {'projects.biodiversity.be': 60,  # Catalogue pages are big
+                 'www.wikidata.org': 30}  # (SPARQL queries have their own timeout, see SparqlClient)
+
 TEST_MODE = False
 TEST_MODE_LIMIT = 50  # In test mode, how many edits do we perform?
 
-SPARQL_QUERY_THROTTLING = True
+# Edits are submitted by a dedicated thread (see EditExecutor), fed by a queue of this size: when it's full, the
+# catalogue processing waits for the edits to catch up
+EDIT_QUEUE_SIZE = 100
+EDIT_MAXLAG = 5  # seconds, maxlag parameter of our edits (without pywikibot, which uses the one of user-config.py)
+
+SPARQL_QUERY_THROTTLING = True  # Rate-limit our SPARQL queries (adaptive token bucket)
+SPARQL_MAX_QUERIES_PER_SECOND = 5
+SPARQL_MAX_CONCURRENT_QUERIES = 4  # WDQS allows up to 5 concurrent queries per client
+SPARQL_QUERY_TIMEOUT_BUDGET = 300  # Maximum time (in seconds) spent on a single query, retries included
+SPARQL_VALUES_BATCH_SIZE = 200  # How many names/IDs are resolved by a single SPARQL query
+SPARQL_STRING_ESCAPES = {'\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r', '\t': '\\t'}  # Escapes of the SPARQL string literals
+
+# Sharded read phase (see --workers): pages dispatched to each worker process and not yet written, at most
+SHARD_PAGES_IN_FLIGHT = 2
+
+LEPIDO_ID_PROPERTY_ID = 'P5862'
+
+# Persistent cache for get_wikidata_q_identifiers(). Set LOOKUP_CACHE_PATH to None to disable it.
+LOOKUP_CACHE_PATH = 'lookup_cache.sqlite3'
+LOOKUP_CACHE_FOUND_TTL = 30 * DAY
+LOOKUP_CACHE_NOT_FOUND_TTL = 7 * DAY  # Negative results expire sooner: someone might create the missing entry
+LOOKUP_CACHE_MULTIPLE_TTL = 7 * DAY  # Same for duplicates, that might get merged
+LOOKUP_CACHE_MAX_ENTRIES = 200000
+
+# Load all P5862 -> item mappings at startup, so lepidoptera lookups don't need any SPARQL query
+PREFETCH_LEPIDO_IDS = True
+LEPIDO_ID_PREFETCH_PAGE_SIZE = 10000
+
+# Load all (lepidoptera, host plant) P2975 claims already sourced with the catalogue at startup: lepidoptera whose
+# host plants are all in there don't need to be fetched (nor edited)
+PREFETCH_HOST_CLAIMS = True
+HOST_CLAIMS_PREFETCH_PAGE_SIZE = 10000
+
+# Settle multiple matches (lepido ID on several items, plant name shared by several taxa) with the taxonomic context
+# of the candidates: duplicate markers, kingdom, parent taxon
+DISAMBIGUATE_MULTIPLE_MATCHES = True
+
+UNMATCHED_PLANT_CANDIDATES = 5  # Number of candidates suggested for each unmatched plant (see --unmatched-report)
+
+# Kind of lookups performed by get_wikidata_q_identifiers()
+LOOKUP_SPECIES = 'species'
+LOOKUP_GENUS = 'genus'
+LOOKUP_LEPIDO_ID = 'lepido_id'
 
 class MultipleWikidataEntriesFound(Exception):
     pass
@@ -40,263 +123,1255 @@ class NoWikidataEntriesFound(Exception):
 class TestModeCompleted(Exception):
     pass
 
-@functools.lru_cache(maxsize=4096)
-def get_wikidata_q_identifier(species_name=None, lepido_id=None, genus_name=None):
-    # If a species name/genus name is passed, search is performed on it.
-    # If a lepidoptera_id is passed, search is performed on it.
+def sparql_string_literal(value: str) -> str:
+    # The endpoint must give us back exactly the same string (see get_wikidata_q_identifiers())
+    return '"' + ''.join(SPARQL_STRING_ESCAPES.get(character, character) for character in value) + '"'
+
+def run_sparql_query(query: str) -> List[Dict[str, Any]]:
+    global sparql_client
+    return sparql_client.query(query)
+
+def run_sparql_queries(queries: List[str]) -> List[List[Dict[str, Any]]]:
+    global sparql_client
+    return sparql_client.query_many(queries)
+
+def q_code_from_uri(uri: str) -> str:
+    return uri.rsplit('/', 1)[-1]  # Get Wikidata URI, split for the Q identifier
 
-    # If used with a species name / genus name, can be used for all kind of species (not only lepidoptera)
-    if species_name:
-        # We previously searched on the label, but this one is often sets 
-        # to some vernacular name. Taxon name seems very often populated, 
+def build_batch_lookup_query(lookup_kind: str, values: List[str]) -> str:
+    if lookup_kind == LOOKUP_SPECIES:
+        # We previously searched on the label, but this one is often sets
+        # to some vernacular name. Taxon name seems very often populated,
         # so it seems it's a better candidate.
-        query = f'''SELECT ?item ?itemLabel WHERE {{
-            ?item wdt:{TAXON_NAME_PROPERTY_ID} "{species_name}". 
-            ?item wdt:{TAXON_RANK_PROPERTY_ID} wd:{SPECIES_VALUE_ID}.
-            }}'''
-    elif lepido_id:
-        query = f'''SELECT ?item ?itemLabel WHERE {{
-            ?item wdt:P5862 "{lepido_id}";
-            wdt:{TAXON_RANK_PROPERTY_ID} wd:{SPECIES_VALUE_ID}.
-            }}'''
+        property_id, rank_value_id = TAXON_NAME_PROPERTY_ID, SPECIES_VALUE_ID
+    elif lookup_kind == LOOKUP_LEPIDO_ID:
+        property_id, rank_value_id = LEPIDO_ID_PROPERTY_ID, SPECIES_VALUE_ID
     else:
-        query = f'''SELECT ?item ?itemLabel WHERE {{
-            ?item wdt:{TAXON_NAME_PROPERTY_ID} "{genus_name}". 
-            ?item wdt:{TAXON_RANK_PROPERTY_ID} wd:{GENUS_VALUE_ID}.
-            }}'''
-    
-    data = requests.get(WIKIDATA_SPARQL_ENDPOINT, params={'query': query.replace('\n', ' '), 'format': 'json'}).json()
-    if SPARQL_QUERY_THROTTLING:
-        time.sleep(1)    
-    
-    results = data['results']['bindings']
-    if len(results) == 1:
-        return results[0]['item']['value'].rsplit('/', 1)[-1]  # Get Wikidata URI, split for the Q identifier
-    elif len(results) == 0:
+        property_id, rank_value_id = TAXON_NAME_PROPERTY_ID, GENUS_VALUE_ID
+
+    values_str = ' '.join(sparql_string_literal(value) for value in values)
+    return f'''SELECT ?value ?item WHERE {{
+        VALUES ?value {{ {values_str} }}
+        ?item wdt:{property_id} ?value;
+        wdt:{TAXON_RANK_PROPERTY_ID} wd:{rank_value_id}.
+        }}'''
+
+def get_wikidata_q_identifiers(species_names=(), lepido_ids=(), genus_names=()) -> Dict[Tuple[str, str], List[str]]:
+    # Looks up species names, lepido IDs and genus names: values are sent by blocks of SPARQL_VALUES_BATCH_SIZE
+    # in a VALUES clause, so a whole catalogue page only costs a few requests.
+    #
+    # Returns a dict (lookup kind, value) -> list of matching Q identifiers. An empty list means no match,
+    # more than one element means multiple matches (see resolved_q_identifier()).
+    #
+    # Values already known by the persistent lookup cache (including unmatched/ambiguous ones) are not queried.
+    # If the P5862 index has been prefetched, lepido IDs are resolved from it.
+    # With a dump index (--dump-index), everything is resolved locally.
+    global lookup_cache
+    global lepido_id_index
+    global dump_index
+
+    results = {}  # type: Dict[Tuple[str, str], List[str]]
+
+    for lookup_kind, values in ((LOOKUP_SPECIES, species_names), (LOOKUP_LEPIDO_ID, lepido_ids), (LOOKUP_GENUS, genus_names)):
+        values = list(dict.fromkeys(str(value) for value in values))  # Deduplicated, in the given order
+
+        if dump_index is not None:
+            if lookup_kind == LOOKUP_LEPIDO_ID:
+                found = dump_index.lookup_lepido_ids(values, SPECIES_VALUE_ID)
+            else:
+                found = dump_index.lookup_taxa(values, SPECIES_VALUE_ID if lookup_kind == LOOKUP_SPECIES else GENUS_VALUE_ID)
+            for value, q_codes in found.items():
+                results[(lookup_kind, value)] = q_codes
+            continue
+
+        if lookup_kind == LOOKUP_LEPIDO_ID and lepido_id_index is not None:
+            for value in values:
+                results[(lookup_kind, value)] = lepido_id_index.get(value, [])
+            continue
+
+        if lookup_cache is not None:
+            cached = lookup_cache.get_many(lookup_kind, values)
+            for value, q_codes in cached.items():
+                results[(lookup_kind, value)] = q_codes
+            values = [value for value in values if value not in cached]
+
+        batches = [values[i:i + SPARQL_VALUES_BATCH_SIZE] for i in range(0, len(values), SPARQL_VALUES_BATCH_SIZE)]
+        batches_bindings = run_sparql_queries([build_batch_lookup_query(lookup_kind, batch) for batch in batches])
+
+        for batch, bindings in zip(batches, batches_bindings):
+            batch_results = {value: [] for value in batch}  # type: Dict[str, List[str]]
+
+            for binding in bindings:
+                if binding['value']['value'] not in batch_results:
+                    logger.warning(f"Unexpected value in the {lookup_kind} lookup results: {binding['value']['value']!r}")
+                    continue
+                q_codes = batch_results[binding['value']['value']]
+                q_code = q_code_from_uri(binding['item']['value'])
+                if q_code not in q_codes:
+                    q_codes.append(q_code)
+
+            for value, q_codes in batch_results.items():
+                results[(lookup_kind, value)] = q_codes
+            if lookup_cache is not None:
+                lookup_cache.put_many(lookup_kind, batch_results)
+
+    return results
+
+def resolved_q_identifier(resolved: Dict[Tuple[str, str], List[str]], lookup_kind: str, value) -> str:
+    q_codes = resolved[(lookup_kind, str(value))]
+    if len(q_codes) == 1:
+        return q_codes[0]
+    elif len(q_codes) == 0:
         raise NoWikidataEntriesFound
-    elif len(results) > 1:
+    else:
         raise MultipleWikidataEntriesFound
 
-def has_host_plant_observations(species_data):
-    observations = species_data['observations']
-    for observation in observations:
-        if observation['observationType'] in ('HostPlantSpecies', 'HostPlantGenus'):
-            return True
-    return False
+def prefetch_lepido_ids() -> Dict[str, List[str]]:
+    # Load the whole P5862 (Catalogue of Lepidoptera of Belgium ID) -> Q identifiers index,
+    # with a few paged SPARQL queries.
+    index = {}  # type: Dict[str, List[str]]
 
+    offset = 0
+    while True:
+        query = f'''SELECT ?item ?lepido_id WHERE {{
+            ?item wdt:{LEPIDO_ID_PROPERTY_ID} ?lepido_id;
+            wdt:{TAXON_RANK_PROPERTY_ID} wd:{SPECIES_VALUE_ID}.
+            }} ORDER BY ?lepido_id ?item LIMIT {LEPIDO_ID_PREFETCH_PAGE_SIZE} OFFSET {offset}'''
+        bindings = run_sparql_query(query)
 
-def get_wikidata_data(q_code: str) -> Dict[str, Any]:
-    global repo
+        for binding in bindings:
+            q_codes = index.setdefault(binding['lepido_id']['value'], [])
+            q_code = q_code_from_uri(binding['item']['value'])
+            if q_code not in q_codes:
+                q_codes.append(q_code)
 
-    item = pywikibot.ItemPage(repo, q_code)
-    return item.get()
+        if len(bindings) < LEPIDO_ID_PREFETCH_PAGE_SIZE:
+            break
+        offset = offset + LEPIDO_ID_PREFETCH_PAGE_SIZE
 
-@functools.lru_cache() # We can cache it since the script will not run on multiple days
-def build_sources_claims() -> List[pywikibot.Claim]:
-    global repo
+    return index
 
-    # It's stated in the catalogue of lepidoptera of Belgium
-    statedin = pywikibot.Claim(repo, STATED_IN_PROPERTY_ID)
-    catalogue_lepido_belgium = pywikibot.ItemPage(repo, CATALOGUE_Q_VALUE)
-    statedin.setTarget(catalogue_lepido_belgium)
+def prefetch_host_claims() -> Set[Tuple[str, str]]:
+    # (lepidoptera, host plant) pairs of the P2975 claims of the catalogue taxa (items with a P5862) that already
+    # cite the catalogue as a source, with a few paged SPARQL queries.
+    synchronized = set()  # type: Set[Tuple[str, str]]
 
-    retrieved = pywikibot.Claim(repo, RETRIEVED_PROPERTY_ID)
-    today = datetime.datetime.today()
-    date = pywikibot.WbTime(year=today.year, month=today.month, day=today.day)
-    retrieved.setTarget(date)
+    offset = 0
+    while True:
+        query = f'''SELECT ?item ?plant WHERE {{
+            ?item wdt:{LEPIDO_ID_PROPERTY_ID} ?lepido_id;
+            p:{HOST_PROPERTY_ID} ?statement.
+            ?statement ps:{HOST_PROPERTY_ID} ?plant;
+            prov:wasDerivedFrom/pr:{STATED_IN_PROPERTY_ID} wd:{CATALOGUE_Q_VALUE}.
+            }} ORDER BY ?item ?plant LIMIT {HOST_CLAIMS_PREFETCH_PAGE_SIZE} OFFSET {offset}'''
+        bindings = run_sparql_query(query)
 
-    return [statedin, retrieved]
+        for binding in bindings:
+            synchronized.add((q_code_from_uri(binding['item']['value']), q_code_from_uri(binding['plant']['value'])))
 
-def add_claim(target_item_q_code: str, property_id: str, property_value_q_code: str, summary:str, sources:Optional[List[pywikibot.Claim]]=None):
-    global repo
+        if len(bindings) < HOST_CLAIMS_PREFETCH_PAGE_SIZE:
+            break
+        offset = offset + HOST_CLAIMS_PREFETCH_PAGE_SIZE
 
-    item = pywikibot.ItemPage(repo, target_item_q_code)
-    claim = pywikibot.Claim(repo, HOST_PROPERTY_ID)
-    target = pywikibot.ItemPage(repo, property_value_q_code)
-    claim.setTarget(target)
-    
-    if sources:
-        claim.addSources(sources, summary='Adding sources.')
+    return synchronized
 
-    item.addClaim(claim, summary=summary)
+def resolve_plant_names(species_names, genus_names) -> Dict[Tuple[str, str], List[str]]:
+    # With a plant name index (--plant-index), host plants are resolved locally, by exact then normalized name.
+    # Only the names it doesn't know are looked up the usual way.
+    global plant_name_index
 
-def add_host_plant_claim(lepido_q_code: str, plant_q_code: str):
-    add_claim(lepido_q_code, HOST_PROPERTY_ID, plant_q_code, 'Add host plant information', sources=build_sources_claims())
+    if plant_name_index is None:
+        return get_wikidata_q_identifiers(species_names=species_names, genus_names=genus_names)
 
-def claims_reference_us(claim: pywikibot.Claim) -> bool:
-    for source in claim.sources:
-        if STATED_IN_PROPERTY_ID in source:
-            for source_claim in source[STATED_IN_PROPERTY_ID]:
-                if source_claim.target.id == CATALOGUE_Q_VALUE:
-                    return True
+    resolved = {}  # type: Dict[Tuple[str, str], List[str]]
+    not_found = {}  # type: Dict[str, List[str]]
+    for lookup_kind, names, rank_value_id in ((LOOKUP_SPECIES, species_names, SPECIES_VALUE_ID), (LOOKUP_GENUS, genus_names, GENUS_VALUE_ID)):
+        for name, q_codes in plant_name_index.lookup(names, rank_value_id).items():
+            resolved[(lookup_kind, name)] = q_codes
+            if not q_codes:
+                not_found.setdefault(lookup_kind, []).append(name)
 
-    return False
+    if not_found:
+        resolved.update(get_wikidata_q_identifiers(species_names=not_found.get(LOOKUP_SPECIES, ()),
+                                                   genus_names=not_found.get(LOOKUP_GENUS, ())))
+    return resolved
+
+def resolve_catalogue_page(page_results: List[SpeciesRecord]) -> Dict[Tuple[str, str], List[str]]:
+    # Resolve, in bulk, all Wikidata identifiers needed to import a page of the catalogue (or the whole catalogue,
+    # see --two-pass): the lepidoptera (by lepido ID) and all their host plants (species and genera). Each distinct
+    # plant name is looked up once, the most cited first.
+    candidates = [species_data for species_data in page_results
+                  if not species_data.is_synonym and species_data.has_host_plants]
+
+    plant_species_counts = collections.Counter()  # type: Counter[str]
+    plant_genera_counts = collections.Counter()  # type: Counter[str]
+    for species_data in candidates:
+        plant_species_counts.update(set(species_data.host_plant_species))
+        plant_genera_counts.update(set(species_data.host_plant_genera))
+
+    def by_frequency(counts: Counter) -> List[str]:
+        return sorted(counts, key=lambda name: (-counts[name], name))
+
+    resolved = get_wikidata_q_identifiers(lepido_ids=[species_data.id for species_data in candidates])
+    resolved.update(resolve_plant_names(by_frequency(plant_species_counts), by_frequency(plant_genera_counts)))
+
+    # Lepidoptera not found by ID: we'll also need to look for a candidate by name
+    not_found_names = [species_data.name for species_data in candidates
+                       if not resolved[(LOOKUP_LEPIDO_ID, str(species_data.id))]]
+    resolved.update(get_wikidata_q_identifiers(species_names=not_found_names))
+
+    # Expected kingdom and parent taxon (the genus, for species) of what we looked up
+    expected = {}  # type: Dict[Tuple[str, str], Tuple[str, Optional[str]]]
+    for species_data in candidates:
+        expected[(LOOKUP_LEPIDO_ID, str(species_data.id))] = (ANIMALIA_Q_VALUE, genus_name(species_data.name))
+    for name in plant_species_counts:
+        expected[(LOOKUP_SPECIES, name)] = (PLANTAE_Q_VALUE, genus_name(name))
+    for name in plant_genera_counts:
+        expected[(LOOKUP_GENUS, name)] = (PLANTAE_Q_VALUE, None)
+    resolved.update(disambiguate_matches(resolved, expected))
+
+    return resolved
+
+def disambiguate_matches(resolved: Dict[Tuple[str, str], List[str]], expected: Dict[Tuple[str, str], Tuple[str, Optional[str]]]) -> Dict[Tuple[str, str], List[str]]:
+    # Lookups with multiple matches are settled in bulk with the taxonomic context of their candidates (a few SPARQL
+    # queries): items marked as duplicates are left out, then the ones outside of the expected kingdom, then the ones
+    # whose parent taxon isn't the expected one. Decisions are kept in the lookup cache with their rationale, so
+    # they cost nothing in the next runs.
+    #
+    # expected: (lookup kind, value) -> (kingdom Q code, parent taxon name or None).
+    # Returns the resolved entries that could be settled, with the chosen Q code only.
+    global lookup_cache
+    global run_report
 
-def add_us_as_source(existing_claim: pywikibot.Claim):
-    existing_claim.addSources(build_sources_claims())
+    ambiguous = {key: resolved[key] for key in expected if len(resolved.get(key, [])) > 1}
+    if not DISAMBIGUATE_MULTIPLE_MATCHES or dump_index is not None or not ambiguous:
+        return {}
 
+    decisions = {}  # type: Dict[Tuple[str, str], Tuple[Optional[str], str]]
+    if lookup_cache is not None:
+        for lookup_kind in {lookup_kind for lookup_kind, _ in ambiguous}:
+            cached = lookup_cache.get_disambiguations(lookup_kind, {value: q_codes for (kind, value), q_codes in ambiguous.items() if kind == lookup_kind})
+            for value, decision in cached.items():
+                decisions[(lookup_kind, value)] = decision
 
-def update_host_properties(lepido_q_code: str, plant_species_names: List[str], plant_genera_names: List[str]):
-    global duplicate_hp_entries_counter
-    global editions_counter
-    global unmatched_plants_set
+    pending = [key for key in ambiguous if key not in decisions]
+    if pending:
+        candidates = sorted({(q_code, expected[key][0]) for key in pending for q_code in ambiguous[key]})
+        batches = [candidates[i:i + SPARQL_VALUES_BATCH_SIZE] for i in range(0, len(candidates), SPARQL_VALUES_BATCH_SIZE)]
+        contexts = {}
+        for bindings in run_sparql_queries([candidates_context_query(batch) for batch in batches]):
+            contexts.update(parse_candidates_context(bindings))
 
-    # 1. Get q codes for plant species
+        new_decisions = {}  # type: Dict[str, Dict[str, Tuple[List[str], Optional[str], str]]]
+        for key in pending:
+            kingdom, parent_name = expected[key]
+            candidate_contexts = {q_code: contexts[(q_code, kingdom)] for q_code in ambiguous[key] if (q_code, kingdom) in contexts}
+            decisions[key] = choose_candidate(ambiguous[key], candidate_contexts, kingdom, parent_name)
+            new_decisions.setdefault(key[0], {})[key[1]] = (ambiguous[key],) + decisions[key]
+        if lookup_cache is not None:
+            for lookup_kind, kind_decisions in new_decisions.items():
+                lookup_cache.put_disambiguations(lookup_kind, kind_decisions)
+
+    settled = {}
+    for (lookup_kind, value), (chosen, rationale) in decisions.items():
+        if chosen is None:
+            logger.debug(f"Multiple Wikidata entries for {lookup_kind} {value}: {rationale}")
+            continue
+
+        logger.info(f"Multiple Wikidata entries for {lookup_kind} {value}, chose {chosen}: {rationale}")
+        metrics.increment('disambiguated_entries')
+        settled[(lookup_kind, value)] = [chosen]
+        if run_report is not None:
+            run_report['disambiguations'].append({'kind': lookup_kind, 'name': value, 'chosen': chosen,
+                                                  'candidates': ambiguous[(lookup_kind, value)], 'rationale': rationale})
+    return settled
+
+
+def iter_wikidata_data(q_codes: List[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # Load the Wikidata entities (as JSON) by batches of WBGETENTITIES_BATCH_SIZE, with a single wbgetentities
+    # call per batch. Only the claims (and revision info) are requested: labels, descriptions and sitelinks
+    # are useless to us. Entities are yielded as soon as their batch arrives.
+    #
+    # With a dump index (--dump-index), entities are read from it instead.
+    global dump_index
+
+    if dump_index is not None:
+        with metrics.timer('entity_read'):
+            entities = list(dump_index.get_entities(q_codes))
+        yield from entities
+        return
+
+    for i in range(0, len(q_codes), WBGETENTITIES_BATCH_SIZE):
+        batch = q_codes[i:i + WBGETENTITIES_BATCH_SIZE]
+        with metrics.timer('entity_read'):
+            data = http_client.get(WIKIBASE_API_ENDPOINT, params={'action': 'wbgetentities',
+                                                                  'ids': '|'.join(batch),
+                                                                  'props': 'info|claims',
+                                                                  'format': 'json'}).json()
+
+        for q_code, entity in data['entities'].items():
+            if 'missing' in entity:
+                logger.warning(f"Wikidata entity {q_code} doesn't exist (anymore?)")
+                continue
+
+            # Redirected entities are returned under their new identifier
+            yield entity.get('redirects', {}).get('from', q_code), entity
+
+def get_current_revisions(q_codes: List[str]) -> Dict[str, int]:
+    # Current revision id of the items (missing items are left out): from the recent changes feed if we have one
+    # (see --recent-changes, items that are not in there didn't change), otherwise with cheap wbgetentities calls
+    # (revision info only, no claims).
+    global dump_index
+    global recent_changes
+
+    if recent_changes is not None:
+        revisions = {}
+        for q_code in q_codes:
+            revision = recent_changes.get(q_code, catalogue_snapshot.item_revision(q_code))
+            if revision is not None:
+                revisions[q_code] = revision
+        return revisions
+
+    if dump_index is not None:
+        return {q_code: entity['lastrevid'] for q_code, entity in dump_index.get_entities(q_codes)}
+
+    revisions = {}
+    for i in range(0, len(q_codes), WBGETENTITIES_BATCH_SIZE):
+        batch = q_codes[i:i + WBGETENTITIES_BATCH_SIZE]
+        with metrics.timer('revision_check'):
+            data = http_client.get(WIKIBASE_API_ENDPOINT, params={'action': 'wbgetentities',
+                                                                  'ids': '|'.join(batch),
+                                                                  'props': 'info',
+                                                                  'format': 'json'}).json()
+
+        for q_code, entity in data['entities'].items():
+            if 'missing' not in entity:
+                revisions[entity.get('redirects', {}).get('from', q_code)] = entity['lastrevid']
+    return revisions
+
+def load_recent_changes(path: str) -> Dict[str, int]:
+    # Latest revision id per item, from a recent changes feed saved as JSON lines: entries of the recentchanges API
+    # (list=recentchanges&rcprop=title|ids) or events of the EventStreams recentchange stream.
+    revisions = {}  # type: Dict[str, int]
+    with open(path) as feed_file:
+        for line in feed_file:
+            if not line.strip():
+                continue
+            change = json.loads(line)
+            revision = change.get('revid') or change.get('revision', {}).get('new')
+            if revision:
+                revisions[change['title']] = max(revision, revisions.get(change['title'], 0))
+    return revisions
+
+def edited_items(species_ids: List[Any]) -> Dict[str, List[str]]:
+    # Items we synchronized for these species that were edited (by anyone) since: Q code -> species ids. Items
+    # whose revision we didn't record (host plants found already synchronized without reading the item) count as
+    # edited, so they're read once.
+    items = catalogue_snapshot.synchronized_items(species_ids)
+    if not items:
+        return {}
+
+    current_revisions = get_current_revisions(list(items))
+    metrics.increment('revision_checks', len(items))
+    return {q_code: item_species_ids for q_code, item_species_ids in items.items()
+            if catalogue_snapshot.item_revision(q_code) is None or current_revisions.get(q_code) != catalogue_snapshot.item_revision(q_code)}
+
+def snak_item_id(snak: Dict[str, Any]) -> Optional[str]:
+    # Q identifier of the value of an item snak (None for "unknown value" / "no value" snaks)
+    return snak.get('datavalue', {}).get('value', {}).get('id')
+
+def item_snak(property_id: str, q_code: str) -> Dict[str, Any]:
+    return {'snaktype': 'value',
+            'property': property_id,
+            'datavalue': {'type': 'wikibase-entityid',
+                          'value': {'entity-type': 'item', 'numeric-id': int(q_code[1:]), 'id': q_code}}}
+
+@functools.lru_cache() # We can cache it since the script will not run on multiple days
+def build_reference() -> Dict[str, Any]:
+    # It's stated in the catalogue of lepidoptera of Belgium, retrieved today
+    today = datetime.datetime.today()
+    retrieved = {'snaktype': 'value',
+                 'property': RETRIEVED_PROPERTY_ID,
+                 'datavalue': {'type': 'time',
+                               'value': {'time': today.strftime('+%Y-%m-%dT00:00:00Z'),
+                                         'timezone': 0, 'before': 0, 'after': 0,
+                                         'precision': 11,  # Day
+                                         'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'}}}
+
+    return {'snaks': {STATED_IN_PROPERTY_ID: [item_snak(STATED_IN_PROPERTY_ID, CATALOGUE_Q_VALUE)],
+                      RETRIEVED_PROPERTY_ID: [retrieved]},
+            'snaks-order': [STATED_IN_PROPERTY_ID, RETRIEVED_PROPERTY_ID]}
+
+def build_host_plant_claim(plant_q_code: str) -> Dict[str, Any]:
+    return {'type': 'statement',
+            'rank': 'normal',
+            'mainsnak': item_snak(HOST_PROPERTY_ID, plant_q_code),
+            'references': [build_reference()]}
+
+def with_us_as_source(existing_claim: Dict[str, Any]) -> Dict[str, Any]:
+    # Since the claim has an id, wbeditentity will update it (with our additional reference) instead of creating a new one
+    claim = dict(existing_claim)
+    claim['references'] = existing_claim.get('references', []) + [build_reference()]
+    return claim
+
+def submit_item_edit(lepido_q_code: str, claims: List[Dict[str, Any]], base_revision_id: Optional[int], summary: str) -> Optional[int]:
+    # All the new/updated claims of an item are sent as a single wbeditentity call (so a single revision, and
+    # a single put_throttle wait). baserevid lets the server detect edit conflicts. Returns the new revision id.
+    global repo
+
+    with metrics.timer('edit'):
+        if repo is None:  # Stand-in Wikibase API (see --standin): no login, no edit token
+            response = http_client.post(WIKIBASE_API_ENDPOINT, data={'action': 'wbeditentity',
+                                                                     'id': lepido_q_code,
+                                                                     'data': json.dumps({'claims': claims}),
+                                                                     'baserevid': base_revision_id,
+                                                                     'summary': summary,
+                                                                     'bot': 1,
+                                                                     'maxlag': EDIT_MAXLAG,
+                                                                     'format': 'json'})
+            result = response.json()
+            if result.get('error', {}).get('code') == 'maxlag':
+                raise MaxlagExceeded(float(response.headers.get('Retry-After') or result['error'].get('lag') or EDIT_MAXLAG))
+            if 'error' in result:
+                raise Exception(f"Edit of {lepido_q_code} failed: {result['error']}")
+        else:
+            result = repo.editEntity({'id': lepido_q_code}, {'claims': claims}, baserevid=base_revision_id, summary=summary, bot=True)
+
+    return result.get('entity', {}).get('lastrevid')
+
+def claims_reference_us(claim: Dict[str, Any]) -> bool:
+    for source in claim.get('references', []):
+        for source_snak in source['snaks'].get(STATED_IN_PROPERTY_ID, []):
+            if snak_item_id(source_snak) == CATALOGUE_Q_VALUE:
+                return True
+
+    return False
+
+
+def resolved_plant_q_codes(plant_species_names: List[str], plant_genera_names: List[str], resolved: Dict[Tuple[str, str], List[str]]) -> Set[str]:
+    # Q codes of our plant species and genera (already resolved for the whole catalogue page)
     plant_q_codes = set()
 
-    # For plant species
-    for plant_name in plant_species_names:
-        try:
-            plant_q_codes.add(get_wikidata_q_identifier(species_name=plant_name))
-        except NoWikidataEntriesFound:
-            if plant_name not in unmatched_plants_set:
-                unmatched_plants_set.add(plant_name)
-                logger.warning(f'No wikidata entry found for plant species: {plant_name}')
-        except MultipleWikidataEntriesFound:
-            duplicate_hp_entries_counter = duplicate_hp_entries_counter + 1
-            logger.warning(f'Multiple wikidata entry found for plant: {plant_name}')
+    for lookup_kind, plant_names in ((LOOKUP_SPECIES, plant_species_names), (LOOKUP_GENUS, plant_genera_names)):
+        for plant_name in dict.fromkeys(plant_names):  # A plant cited several times counts once per lepidoptera
+            try:
+                plant_q_codes.add(resolved_q_identifier(resolved, lookup_kind, plant_name))
+            except NoWikidataEntriesFound:
+                if (lookup_kind, plant_name) not in metrics.unmatched_plants:
+                    logger.warning(f'No wikidata entry found for plant {lookup_kind}: {plant_name}')
+                metrics.unmatched_plants[(lookup_kind, plant_name)] = metrics.unmatched_plants.get((lookup_kind, plant_name), 0) + 1
+            except MultipleWikidataEntriesFound:
+                metrics.increment('duplicate_hostplant_entries')
+                logger.warning(f'Multiple wikidata entry found for plant: {plant_name}')
 
-    # For plant genera
-    # TODO: Factorize w/ plant species
-    for plant_name in plant_genera_names:
-        try:
-            plant_q_codes.add(get_wikidata_q_identifier(genus_name=plant_name))
-        except NoWikidataEntriesFound:
-            if plant_name not in unmatched_plants_set:
-                unmatched_plants_set.add(plant_name)
-                logger.warning(f'No wikidata entry found for plant genus: {plant_name}')
-        except MultipleWikidataEntriesFound:
-            duplicate_hp_entries_counter = duplicate_hp_entries_counter + 1
-            logger.warning(f'Multiple wikidata entry found for plant: {plant_name}')
-    
+    return plant_q_codes
+
+def plan_host_properties(lepido_q_code: str, plant_q_codes: Set[str], lepi_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Compare our host plants with the ones already at Wikidata, and return the edit record (see apply_edit_record())
+    # needed to synchronize them, or None if there's nothing to do.
     plant_q_codes_to_create = plant_q_codes.copy()
+    claims_to_reference = []  # Ids of existing claims, to which we have to add us as a source
 
-    # 2. For each of this plants, check if the lepidoptera has already the host property set
-    lepi_data = get_wikidata_data(q_code=lepido_q_code)
+    # For each of this plants, check if the lepidoptera has already the host property set
     if HOST_PROPERTY_ID in lepi_data['claims']: # Wikidata already has host plants info for this lepidoptera
         logger.info("Wikidata already has some host plant info for this lepidoptera")
         # Update, if necessary
         for existing_claim in lepi_data['claims'][HOST_PROPERTY_ID]:
             # Does this claim concern a plant we also have:
-                if existing_claim.target.id in plant_q_codes: # Yes
-                    logger.info(f"Wikidata already knows about this lepidoptera <-> host plant ({existing_claim.target.id}) relationship")
-                    plant_q_codes_to_create.remove(existing_claim.target.id)  # In all cases, we don't need to create a new claim
+                existing_plant_q_code = snak_item_id(existing_claim['mainsnak'])
+                if existing_plant_q_code in plant_q_codes: # Yes
+                    logger.info(f"Wikidata already knows about this lepidoptera <-> host plant ({existing_plant_q_code}) relationship")
+                    plant_q_codes_to_create.discard(existing_plant_q_code)  # In all cases, we don't need to create a new claim
                     if claims_reference_us(existing_claim):
                         logger.info("We already cited as a source -> do nothing")
                     else:
                         logger.info("We have to add us as a source for this claim")
-                        add_us_as_source(existing_claim)
-                        editions_counter = editions_counter + 1
+                        claims_to_reference.append(existing_claim['id'])
                 
             
     else:
         logger.info("No host plant info for this lepidoptera @Wikidata yet")
-    
+
+    if not plant_q_codes_to_create and not claims_to_reference:
+        return None
+
+    return {'lepido_q_code': lepido_q_code,
+            'base_revision_id': lepi_data.get('lastrevid'),
+            'add_host_plants': sorted(plant_q_codes_to_create),
+            'reference_claims': claims_to_reference}
+
+def apply_edit_record(record: Dict[str, Any], lepi_data: Dict[str, Any]) -> bool:
+    # Submit all changes of an edit record as a single edit. The record is checked against the current state of
+    # the item (lepi_data) first, so applying an outdated plan doesn't create duplicate claims or references.
+    # Returns True if an edit was submitted.
+    global checkpoint_journal
+
+    lepido_q_code = record['lepido_q_code']
+    edit_key = edit_record_key(record)
+    if checkpoint_journal.is_edit_done(edit_key):
+        logger.info(f"Edit already submitted for {lepido_q_code} in a previous run, skipping.")
+        return False
+    if checkpoint_journal.is_edit_uncertain(edit_key):
+        # The checks below (against the current state of the item) will avoid a double submission
+        logger.warning(f"An earlier attempt to edit {lepido_q_code} did not complete, checking it again.")
+
+    existing_claims = lepi_data['claims'][HOST_PROPERTY_ID] if HOST_PROPERTY_ID in lepi_data['claims'] else []
+    existing_claims_by_id = {existing_claim['id']: existing_claim for existing_claim in existing_claims if 'id' in existing_claim}
+    existing_plant_q_codes = {snak_item_id(existing_claim['mainsnak']) for existing_claim in existing_claims}
+
+    claims_to_reference = [existing_claims_by_id[claim_id] for claim_id in record['reference_claims']
+                           if claim_id in existing_claims_by_id and not claims_reference_us(existing_claims_by_id[claim_id])]
+    plant_q_codes_to_create = [plant_q_code for plant_q_code in record['add_host_plants']
+                               if plant_q_code not in existing_plant_q_codes]
+
+    claims = [with_us_as_source(existing_claim) for existing_claim in claims_to_reference]
     for plant_q_code in plant_q_codes_to_create:
-        logger.info(f"Adding host plant ({plant_q_code})...")
-        add_host_plant_claim(lepido_q_code, plant_q_code)     
-        editions_counter = editions_counter + 1
-
-
-def import_lepidotera_data(species_data):
-    global synonym_counter
-    global accepted_counter
-    global species_not_found_counter
-    global duplicate_entries_counter
-    global possible_missing_id
-    global no_hostplant_data_counter
-    global editions_counter
-    
-    species_name = species_data['name']
-    species_id = species_data['id']
+        logger.info(f"Adding host plant ({plant_q_code}) to {lepido_q_code}...")
+        claims.append(build_host_plant_claim(plant_q_code))
 
-    if TEST_MODE and (editions_counter >= TEST_MODE_LIMIT):
-        raise TestModeCompleted
+    if not claims:
+        logger.info(f"Nothing to do anymore for {lepido_q_code}")
+        return False
+
+    summary_parts = []
+    if plant_q_codes_to_create:
+        summary_parts.append(f'Add host plant information ({len(plant_q_codes_to_create)})')
+    if claims_to_reference:
+        summary_parts.append(f'Add sources to host plant claims ({len(claims_to_reference)})')
+
+    checkpoint_journal.edit_started(edit_key)
+    new_revision_id = submit_item_edit(lepido_q_code, claims, lepi_data.get('lastrevid'), summary=', '.join(summary_parts))
+    checkpoint_journal.edit_done(edit_key)
+    if new_revision_id is not None:
+        lepi_data['lastrevid'] = new_revision_id  # The item is now synchronized at the revision we created
+    record_submitted_claims(lepi_data, claims)
+    metrics.increment('editions')
+    return True
+
+def record_submitted_claims(lepi_data: Dict[str, Any], claims: List[Dict[str, Any]]):
+    # Bring the item data in line with an edit we made, so another edit record of the same item (e.g. twice in a
+    # plan) is checked against it. Updated claims replace the existing ones (same id), new ones are appended.
+    submitted_by_id = {claim['id']: claim for claim in claims if 'id' in claim}
+    existing_claims = lepi_data['claims'].get(HOST_PROPERTY_ID, [])
+    lepi_data['claims'][HOST_PROPERTY_ID] = ([submitted_by_id.get(existing_claim.get('id'), existing_claim) for existing_claim in existing_claims]
+                                             + [claim for claim in claims if 'id' not in claim])
+
+def update_host_properties(record: Dict[str, Any], lepi_data: Dict[str, Any]):
+    # Hand the edit record (see plan_host_properties()) to the edit executor. In plan mode, edits are written to the
+    # plan file instead of being applied immediately. In report mode, they are only listed in the report.
+    global edit_plan_file
+    global run_report
+
+    if run_report is not None:
+        run_report['pending_edits'].append(record)
+        metrics.increment('editions')
+    elif edit_plan_file is not None:
+        edit_plan_file.write(json.dumps(record) + '\n')
+        edit_plan_file.flush()  # Before the species get marked as done in the checkpoint journal
+        metrics.increment('editions')
+    else:
+        edit_executor.submit(apply_edit_record, record, lepi_data)
+
+def edited_item_data(q_code: str, lepi_data: Dict[str, Any]) -> Dict[str, Any]:
+    # Items are read ahead of the edits (up to EDIT_QUEUE_SIZE edits). An item edited more than once in a run (on
+    # several catalogue pages, or several plan batches) must be checked against our previous edits, not against
+    # what was read before them: all its edits share the item data of the first one, which apply_edit_record()
+    # keeps up to date. Only what the edits need is kept.
+    global edited_item_states
+
+    if q_code not in edited_item_states:
+        edited_item_states[q_code] = {'lastrevid': lepi_data.get('lastrevid'),
+                                'claims': {HOST_PROPERTY_ID: list(lepi_data['claims'].get(HOST_PROPERTY_ID, []))}}
+    return edited_item_states[q_code]
+
+def after_pending_edits(function, *args):
+    # Progress bookkeeping (checkpoints, snapshot) must wait until the edits submitted so far are done
+    global edit_executor
+
+    if edit_executor is not None:
+        edit_executor.call_when_done(function, *args)
+    else:
+        function(*args)
+
+def check_test_mode():
+    global edit_executor
+
+    if TEST_MODE:
+        if edit_executor is not None:
+            edit_executor.join()  # To count the edits exactly
+        if metrics['editions'] >= TEST_MODE_LIMIT:
+            raise TestModeCompleted
+
+def mark_species_done(species_ids: List[Any]):
+    for species_id in species_ids:
+        checkpoint_journal.species_done(species_id)
+
+def item_synchronized(q_code: str, species_ids: List[Any], lepi_data: Optional[Dict[str, Any]]):
+    # Once the edits of the item are done: remember the revision it's synchronized at (if we read it) for
+    # --track-revisions
+    mark_species_done(species_ids)
+    if catalogue_snapshot is not None and snapshot_updates:
+        catalogue_snapshot.record_item(q_code, lepi_data.get('lastrevid') if lepi_data is not None else None, species_ids)
+
+
+def import_lepidotera_data(species_data: SpeciesRecord, resolved: Dict[Tuple[str, str], List[str]]) -> Optional[Tuple[str, List[str], List[str]]]:
+    # Returns (lepidoptera Q code, plant species names, plant genera names) if the host plants of this species
+    # have to be synchronized with Wikidata, None otherwise.
+    
+    species_name = species_data.name
+    species_id = species_data.id
 
     logger.info(f"Processing {species_name}...")
-    if (species_data['is_synonym']):
-        synonym_counter = synonym_counter + 1
+    if (species_data.is_synonym):
+        metrics.increment('synonyms')
         logger.info("\tSynonym, skipping.")
-    elif not has_host_plant_observations(species_data):
-        no_hostplant_data_counter = no_hostplant_data_counter + 1
+    elif not species_data.has_host_plants:
+        metrics.increment('no_hostplant_data')
         logger.info("We don't have any host plant species data, skipping.")
     else:
-        accepted_counter = accepted_counter + 1
+        metrics.increment('accepted_species')
         try:
-            q_code = get_wikidata_q_identifier(lepido_id=species_id)
+            q_code = resolved_q_identifier(resolved, LOOKUP_LEPIDO_ID, species_id)
 
-            plant_species_names = [obs['name'] for obs in species_data['observations'] if obs['observationType'] == 'HostPlantSpecies']
-            plant_genera_names = [obs['name'] for obs in species_data['observations'] if obs['observationType'] == 'HostPlantGenus']
+            plant_species_names = list(species_data.host_plant_species)
+            plant_genera_names = list(species_data.host_plant_genera)
 
-            update_host_properties(q_code, plant_species_names, plant_genera_names)
+            return q_code, plant_species_names, plant_genera_names
         except NoWikidataEntriesFound:
             # Not found with the ID, check if we have a candidate by name
-            species_not_found_counter = species_not_found_counter + 1
+            metrics.increment('species_not_found')
             logger.warning(f"No Wikidata entry found for {species_name}")
             try:
-                get_wikidata_q_identifier(species_name=species_name)
+                resolved_q_identifier(resolved, LOOKUP_SPECIES, species_name)
                 logger.warning(f"... but we have a candidate by label. Missing lepido ID (P5862) @Wikidata?")
-                possible_missing_id = possible_missing_id + 1
+                metrics.increment('possible_missing_ids')
             except (NoWikidataEntriesFound, MultipleWikidataEntriesFound): 
                 pass   
+            if run_report is not None:
+                run_report['missing_lepido_ids'].append({'catalogue_id': species_id, 'name': species_name,
+                                                         'candidates': resolved.get((LOOKUP_SPECIES, species_name), [])})
 
         except MultipleWikidataEntriesFound:
-            duplicate_entries_counter = duplicate_entries_counter + 1
+            metrics.increment('duplicate_species_entries')
             logger.warning(f"Multiple Wikidata entries found for {species_name}. Check for Wikidata duplicates?")
+            if run_report is not None:
+                run_report['duplicate_lepidoptera'].append({'catalogue_id': species_id, 'name': species_name,
+                                                            'candidates': resolved[(LOOKUP_LEPIDO_ID, str(species_id))]})
 
-def main():
-    logger.info("Getting data from the catalogue of lepidoptera")
+    return None
 
-    # We iterate over accepted lepidoptera species in the catalogue
-    page_num = 1
+def import_catalogue_page(page_results: List[SpeciesRecord], revisited_q_codes: Set[str] = frozenset(),
+                          resolved: Optional[Dict[Tuple[str, str], List[str]]] = None):
+    write_catalogue_page(diff_catalogue_page(page_results, revisited_q_codes, resolved))
+
+def diff_catalogue_page(page_results: List[SpeciesRecord], revisited_q_codes: Set[str] = frozenset(),
+                        resolved: Optional[Dict[Tuple[str, str], List[str]]] = None) -> Iterator[Tuple[Optional[str], List[Any], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]:
+    # Read side of the import of a page: resolution, reading the lepidoptera items and comparing them with the
+    # catalogue. Nothing is written: outcomes are yielded as they're known, as (lepidoptera Q code, species ids,
+    # edit record or None, item data or None if the item wasn't read), with a None Q code for the species we
+    # won't synchronize. See write_catalogue_page() for the write side.
+    #
+    # revisited_q_codes: items edited by others since we synchronized them, that have to be read again
+    # resolved: identifiers already resolved for the whole catalogue (--two-pass), otherwise the page is resolved here
+    global host_claims_index
+
+    if resolved is None:
+        resolved = resolve_catalogue_page(page_results)
+
+    # Host plants to synchronize, per lepidoptera (several catalogue species may point to the same Wikidata item:
+    # their host plants are merged so the item is edited only once)
+    pending_updates = {}  # type: Dict[str, Tuple[List[str], List[str], List[Any]]]
+    for species_data in page_results:
+        to_update = import_lepidotera_data(species_data, resolved)
+        if to_update is not None:
+            q_code, plant_species_names, plant_genera_names = to_update
+            species_names, genera_names, species_ids = pending_updates.setdefault(q_code, ([], [], []))
+            species_names.extend(plant_species_names)
+            genera_names.extend(plant_genera_names)
+            species_ids.append(species_data.id)
+        else:
+            yield None, [species_data.id], None, None
+
+    plant_q_codes = {}  # type: Dict[str, Set[str]]
+    for q_code, (plant_species_names, plant_genera_names, species_ids) in list(pending_updates.items()):
+        plant_q_codes[q_code] = resolved_plant_q_codes(plant_species_names, plant_genera_names, resolved)
+
+        # None of the host plants found (or only ambiguous ones) @Wikidata: nothing we could add, the item is neither
+        # read nor recorded as synchronized
+        if not plant_q_codes[q_code]:
+            logger.info(f"None of the host plants of {q_code} found @Wikidata, skipping.")
+            metrics.increment('unresolved_hostplants')
+            del pending_updates[q_code]
+            yield None, species_ids, None, None
+            continue
+
+        # All host plants already claimed with us as a source: no need to fetch the item
+        if (host_claims_index is not None and q_code not in revisited_q_codes
+                and all((q_code, plant_q_code) in host_claims_index for plant_q_code in plant_q_codes[q_code])):
+            logger.info(f"Host plants of {q_code} are already synchronized, skipping.")
+            metrics.increment('already_synchronized')
+            del pending_updates[q_code]
+            yield q_code, species_ids, None, None
+
+    # Lepidoptera entities are loaded by batches, and processed as they arrive
+    for q_code, lepi_data in iter_wikidata_data(list(pending_updates)):
+        logger.info(f"Updating host plants of {q_code}...")
+        yield q_code, pending_updates[q_code][2], plan_host_properties(q_code, plant_q_codes[q_code], lepi_data), lepi_data
+
+def write_catalogue_page(outcomes: Iterator[Tuple[Optional[str], List[Any], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]):
+    # Write side of the import of a page (see diff_catalogue_page()): edits and progress bookkeeping
+    for q_code, species_ids, record, lepi_data in outcomes:
+        if q_code is None:  # Nothing to synchronize for these species
+            mark_species_done(species_ids)
+            continue
+        if lepi_data is None:  # Already synchronized
+            after_pending_edits(item_synchronized, q_code, species_ids, None)
+            continue
+
+        check_test_mode()
+        if edit_executor is not None and (record is not None or q_code in edited_item_states):
+            lepi_data = edited_item_data(q_code, lepi_data)
+        if record is not None:
+            update_host_properties(record, lepi_data)
+        after_pending_edits(item_synchronized, q_code, species_ids, lepi_data)
+
+def page_identifiers(resolved: Dict[Tuple[str, str], List[str]], page_results: List[SpeciesRecord]) -> Dict[Tuple[str, str], List[str]]:
+    # The part of the resolved identifiers (of the whole catalogue) that a page needs
+    keys = set()
+    for species_data in page_results:
+        keys.update([(LOOKUP_LEPIDO_ID, str(species_data.id)), (LOOKUP_SPECIES, species_data.name)])
+        keys.update((LOOKUP_SPECIES, name) for name in species_data.host_plant_species)
+        keys.update((LOOKUP_GENUS, name) for name in species_data.host_plant_genera)
+    return {key: resolved[key] for key in keys if key in resolved}
+
+def init_shard_worker(args, endpoints: Dict[str, str], lookup_cache_path: Optional[str], lepido_ids: Optional[Dict[str, List[str]]], host_claims: Optional[Set[Tuple[str, str]]]):
+    # Set up a worker process of the sharded read phase (see --workers): its own HTTP session, SPARQL client (with
+    # its share of the rate limit) and connection to the lookup cache. The indexes prefetched by the coordinator are
+    # handed over.
+    global logger, metrics, http_client, sparql_client, lookup_cache, dump_index, plant_name_index
+    global lepido_id_index, host_claims_index, run_report, shard_report
+    global CATALOGUE_SPECIES_DETAILS_ENDPOINT, WIKIDATA_SPARQL_ENDPOINT, WIKIBASE_API_ENDPOINT
+
+    CATALOGUE_SPECIES_DETAILS_ENDPOINT = endpoints['catalogue']
+    WIKIDATA_SPARQL_ENDPOINT = endpoints['sparql']
+    WIKIBASE_API_ENDPOINT = endpoints['api']
+
+    logger = logging.getLogger(__name__)
+    coloredlogs.install(level=LOGLEVEL)
+
+    metrics = RunMetrics()
+    http_client = build_http_client(args)
+    sparql_client = build_sparql_client(args, http_client, metrics, share=args.workers)
+    lookup_cache = build_lookup_cache(lookup_cache_path)
+    dump_index = DumpIndex(args.dump_index) if args.dump_index else None
+    plant_name_index = PlantNameIndex(args.plant_index) if args.plant_index else None
+    lepido_id_index = lepido_ids
+    host_claims_index = host_claims
+    shard_report = args.mode == 'report'
+    run_report = None
+
+def diff_shard_page(page_results: List[SpeciesRecord], revisited_q_codes: Set[str], resolved: Optional[Dict[Tuple[str, str], List[str]]]):
+    # Runs in a worker process: the outcomes of diff_catalogue_page(), and what was counted meanwhile (metrics and
+    # report entries), to be merged by the coordinator
+    global run_report
+
+    run_report = new_run_report() if shard_report else None
+    queries_count = sparql_client.queries_count
+    lookup_hits, lookup_misses = (lookup_cache.hits, lookup_cache.misses) if lookup_cache is not None else (0, 0)
+
+    outcomes = []
+    for q_code, species_ids, record, lepi_data in diff_catalogue_page(page_results, revisited_q_codes, resolved):
+        if lepi_data is not None and record is None:
+            lepi_data = {'lastrevid': lepi_data.get('lastrevid')}  # The writer only needs the revision
+        outcomes.append((q_code, species_ids, record, lepi_data))
+
+    metrics.increment('shard_sparql_queries', sparql_client.queries_count - queries_count)
+    if lookup_cache is not None:
+        metrics.increment('shard_lookup_cache_hits', lookup_cache.hits - lookup_hits)
+        metrics.increment('shard_lookup_cache_misses', lookup_cache.misses - lookup_misses)
+    return outcomes, metrics.drain(), run_report
+
+def import_sharded_pages(pages: Iterator[Tuple[Dict[str, Any], List[SpeciesRecord], Set[str]]],
+                         resolved: Optional[Dict[Tuple[str, str], List[str]]], args):
+    # Sharded read phase (--workers): catalogue pages are dispatched to worker processes that resolve, read and
+    # compare them, while this process stays the single writer (edit executor, plan file, checkpoints). Results are
+    # written in the catalogue order, with at most SHARD_PAGES_IN_FLIGHT pages per worker waiting, so we don't
+    # read too far ahead of the edits. Pages without species to process (unchanged since the last run) wait for
+    # their turn too, so they're never marked as done before the pages in progress.
+    endpoints = {'catalogue': CATALOGUE_SPECIES_DETAILS_ENDPOINT, 'sparql': WIKIDATA_SPARQL_ENDPOINT, 'api': WIKIBASE_API_ENDPOINT}
+    context = multiprocessing.get_context('spawn')  # No fork: this process already runs threads
+
+    def write(response, pending_result):
+        if pending_result is not None:  # None: nothing to process on this page
+            outcomes, worker_metrics, worker_report = pending_result.get()
+            metrics.merge(worker_metrics)
+            if run_report is not None:
+                for section, entries in worker_report.items():
+                    run_report[section].extend(entries)
+            write_catalogue_page(outcomes)
+        after_pending_edits(catalogue_page_done, response)
+
+    with context.Pool(args.workers, initializer=init_shard_worker, initargs=(args, endpoints, LOOKUP_CACHE_PATH, lepido_id_index, host_claims_index)) as pool:
+        in_flight = collections.deque()
+        for response, page_results, revisited_q_codes in pages:
+            if not page_results:
+                in_flight.append((response, None))
+            else:
+                page_resolved = page_identifiers(resolved, page_results) if resolved is not None else None
+                in_flight.append((response, pool.apply_async(diff_shard_page, (page_results, revisited_q_codes, page_resolved))))
+            while len(in_flight) > SHARD_PAGES_IN_FLIGHT * args.workers or (in_flight and (in_flight[0][1] is None or in_flight[0][1].ready())):
+                write(*in_flight.popleft())
+
+        while in_flight:
+            write(*in_flight.popleft())
+
+def fetch_catalogue_page(page_num: int, conditional: bool = True) -> Dict[str, Any]:
+    # The page is parsed while it's downloaded, and its results are compact SpeciesRecord objects.
+    #
+    # In incremental mode, conditional requests are used: pages that didn't change since the last run come back
+    # empty, with 'not_modified' set.
+    global catalogue_snapshot
+    global incremental_sync
+
+    headers = catalogue_snapshot.conditional_headers(page_num) if incremental_sync and conditional else {}
+    with metrics.timer('catalogue_fetch'):
+        response = http_client.get(CATALOGUE_SPECIES_DETAILS_ENDPOINT, params={'page': page_num}, headers=headers, stream=True)
+
+        if response.status_code == 304:
+            return {'page': page_num, 'results': [], 'hasMoreResults': catalogue_snapshot.has_more_pages(page_num), 'not_modified': True}
+
+        chunks = response.iter_content(CATALOGUE_STREAM_CHUNK_SIZE)
+        parser = CataloguePageParser(chunks)
+        results = list(parser)
+        for _ in chunks:  # Read the end of the body (if any), so the connection goes back to the pool
+            pass
+
+    page = dict(parser.metadata, results=results)
+    page['etag'] = response.headers.get('ETag')
+    page['last_modified'] = response.headers.get('Last-Modified')
+    return page
+
+def iter_catalogue_pages(first_page: int = 1):
+    # Yield the catalogue pages, in order. A background thread reads ahead up to CATALOGUE_READ_AHEAD_PAGES
+    # pages into a bounded queue, so the catalogue latency is hidden while we're processing a page.
+    pages = queue.Queue(maxsize=max(1, CATALOGUE_READ_AHEAD_PAGES))
+    stop = threading.Event()
+    end_of_catalogue = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def fetch_pages():
+        page_num = first_page
+        try:
+            while not stop.is_set():
+                response = fetch_catalogue_page(page_num)
+                put(response)
+                if response['hasMoreResults'] == False:
+                    break
+                page_num = page_num + 1
+            put(end_of_catalogue)
+        except Exception as e:
+            put(e)
+
+    fetcher = threading.Thread(target=fetch_pages, name='catalogue-fetcher', daemon=True)
+    fetcher.start()
 
     try:
         while True:
-            response = requests.get(CATALOGUE_SPECIES_DETAILS_ENDPOINT, params={'page': page_num}).json()
-            
-            logger.debug(f"parsing page {response['page']}. Number of results on the page: {len(response['results'])}")
+            item = pages.get()
+            if item is end_of_catalogue:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()  # Also stops the fetcher if the consumer stops early (test mode, error, ...)
+
+def apply_edit_plan(plan_path: str):
+    # Apply an edit plan previously written in plan mode. Records are processed by batches of
+    # WBGETENTITIES_BATCH_SIZE, to load the current state of the items efficiently.
+    def apply_batch(records):
+        lepi_data_by_q_code = dict(iter_wikidata_data([record['lepido_q_code'] for record in records]))
+        for record in records:
+            check_test_mode()
+
+            if record['lepido_q_code'] not in lepi_data_by_q_code:
+                logger.warning(f"Can't load {record['lepido_q_code']}, skipping.")
+                continue
+
+            edit_executor.submit(apply_edit_record, record, edited_item_data(record['lepido_q_code'], lepi_data_by_q_code[record['lepido_q_code']]))
+
+    with open(plan_path) as plan_file:
+        records = []
+        for line in plan_file:
+            if line.strip():
+                records.append(json.loads(line))
+            if len(records) == WBGETENTITIES_BATCH_SIZE:
+                apply_batch(records)
+                records = []
+        apply_batch(records)
+    edit_executor.join()
+
+def import_catalogue(args):
+    global lepido_id_index
+    global host_claims_index
+    global checkpoint_journal
+    global catalogue_snapshot
+    global incremental_sync
+    global track_revisions
+    global two_pass
+
+    if PREFETCH_LEPIDO_IDS and dump_index is None:
+        logger.info(f"Prefetching the {LEPIDO_ID_PROPERTY_ID} index from Wikidata")
+        lepido_id_index = prefetch_lepido_ids()
+        duplicate_ids = [lepido_id for lepido_id, q_codes in lepido_id_index.items() if len(q_codes) > 1]
+        logger.info(f"{len(lepido_id_index)} lepido IDs found @Wikidata, {len(duplicate_ids)} of them on multiple entries")
+        for lepido_id in duplicate_ids:
+            logger.warning(f"Lepido ID {lepido_id} found on multiple Wikidata entries: {', '.join(lepido_id_index[lepido_id])}")
+
+    if PREFETCH_HOST_CLAIMS and dump_index is None:
+        logger.info(f"Prefetching the {HOST_PROPERTY_ID} claims sourced with the catalogue from Wikidata")
+        host_claims_index = prefetch_host_claims()
+        logger.info(f"{len(host_claims_index)} lepidoptera <-> host plant claims already cite the catalogue @Wikidata")
+
+    logger.info("Getting data from the catalogue of lepidoptera")
+
+    if checkpoint_journal.last_completed_page:
+        logger.info(f"Resuming after page {checkpoint_journal.last_completed_page} of the catalogue")
 
-            for result in response['results']:
-                import_lepidotera_data(result)
+    # We iterate over accepted lepidoptera species in the catalogue
+    try:
+        pages = map(select_page_species, iter_catalogue_pages(first_page=checkpoint_journal.last_completed_page + 1))
+        # Species already completed by a previous (interrupted) run
+        pages = ((response, [species_data for species_data in page_results if not checkpoint_journal.is_species_done(species_data.id)], revisited_q_codes)
+                 for response, page_results, revisited_q_codes in pages)
 
-            if response['hasMoreResults'] == False:
-                break
+        resolved = None
+        if two_pass:
+            # First pass: read the whole catalogue, then resolve all the lepido IDs and distinct plant names at once.
+            # The second pass drives the updates from this table.
+            pages = list(pages)
+            logger.info(f"Resolving the identifiers of {sum(len(page_results) for _, page_results, _ in pages)} species")
+            resolved = resolve_catalogue_page([species_data for _, page_results, _ in pages for species_data in page_results])
 
-            page_num = page_num + 1
+        if args.workers > 1:
+            import_sharded_pages(pages, resolved, args)
+        else:
+            for response, page_results, revisited_q_codes in pages:
+                import_catalogue_page(page_results, revisited_q_codes, resolved)
+                after_pending_edits(catalogue_page_done, response)
     except TestModeCompleted:
         logger.info("We'll stop here because we're in test mode.")
-    
+
+    if edit_executor is not None:
+        edit_executor.join()
+
+def select_page_species(response: Dict[str, Any]) -> Tuple[Dict[str, Any], List[SpeciesRecord], Set[str]]:
+    # The species of a catalogue page we have to process (all of them, or in incremental mode, the changed ones and
+    # the ones whose item was edited @Wikidata), with the Q codes of the items to read again. Pages with nothing to
+    # do come back empty: they're marked as done by catalogue_page_done() in the catalogue order, like the others
+    # (the pages are selected ahead of the writes, see --two-pass and --workers).
+    edited = None  # type: Optional[Dict[str, List[str]]]
+    if response.get('not_modified'):
+        if track_revisions:
+            edited = edited_items(catalogue_snapshot.page_species_ids(response['page']))
+        if not edited:
+            logger.info(f"Page {response['page']} of the catalogue didn't change since the last run, skipping.")
+            return response, [], set()
+        logger.info(f"Page {response['page']} of the catalogue didn't change, but {len(edited)} of its lepidoptera were edited @Wikidata since the last run")
+        response = fetch_catalogue_page(response['page'], conditional=False)
+
+    logger.debug(f"parsing page {response['page']}. Number of results on the page: {len(response['results'])}")
+
+    page_results = response['results']
+    revisited_q_codes = set()  # type: Set[str]
+    if incremental_sync:
+        changed_species_ids = {species_data.id for species_data in catalogue_snapshot.changed_species(page_results)}
+        if track_revisions:
+            # Unchanged species are processed again if their item was edited @Wikidata since the last run
+            if edited is None:
+                edited = edited_items([species_data.id for species_data in page_results if species_data.id not in changed_species_ids])
+            revisited_q_codes = set(edited)
+            revisited_species_ids = {species_id for species_ids in edited.values() for species_id in species_ids}
+            metrics.increment('edited_items', len(edited))
+        else:
+            revisited_species_ids = set()
+
+        page_results = [species_data for species_data in page_results
+                        if species_data.id in changed_species_ids or str(species_data.id) in revisited_species_ids]
+        logger.info(f"Page {response['page']}: {len(changed_species_ids)} species changed since the last run, {len(revisited_q_codes)} lepidoptera edited @Wikidata")
+        metrics.increment('unchanged_species', len(response['results']) - len(page_results))
+
+    return response, page_results, revisited_q_codes
+
+def catalogue_page_done(response: Dict[str, Any]):
+    checkpoint_journal.page_done(response['page'])
+
+    if catalogue_snapshot is not None and snapshot_updates and not response.get('not_modified'):
+        catalogue_snapshot.record_page(response['page'], response['results'], response['hasMoreResults'],
+                                       response.get('etag'), response.get('last_modified'))
+        catalogue_snapshot.save()
+
+def unmatched_plants() -> List[Dict[str, Any]]:
+    # Most cited plants first. With a plant name index, each name comes with the closest names of the index.
+    plants = []
+    for (lookup_kind, plant_name), count in sorted(metrics.unmatched_plants.items(), key=lambda item: (-item[1], item[0])):
+        candidates = []
+        if plant_name_index is not None:
+            rank_value_id = SPECIES_VALUE_ID if lookup_kind == LOOKUP_SPECIES else GENUS_VALUE_ID
+            candidates = plant_name_index.candidates(plant_name, rank_value_id, limit=UNMATCHED_PLANT_CANDIDATES)
+        plants.append({'kind': lookup_kind, 'name': plant_name, 'lepidoptera': count,
+                       'candidates': [{'name': name, 'q_code': q_code, 'score': score} for name, q_code, score in candidates]})
+    return plants
+
+def write_unmatched_plants_report(report_path: str):
+    with open(report_path, 'w', newline='') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(['kind', 'name', 'lepidoptera', 'candidates'])
+        for plant in unmatched_plants():
+            writer.writerow([plant['kind'], plant['name'], plant['lepidoptera'],
+                             '; '.join(f"{candidate['name']} ({candidate['q_code']}, {candidate['score']:.2f})" for candidate in plant['candidates'])])
+
+def write_report(report_path: str):
+    # JSON (one list per section), or CSV (one row per entry) if the file name ends with .csv
+    global run_report
+
+    sections = dict(run_report, unmatched_plants=unmatched_plants())
+    if report_path.endswith('.csv'):
+        with open(report_path, 'w', newline='') as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(['section', 'key', 'name', 'details'])
+            for section, entries in sections.items():
+                for entry in entries:
+                    key = entry.get('catalogue_id', entry.get('lepido_q_code', entry.get('kind')))
+                    details = {field: value for field, value in entry.items() if field not in ('catalogue_id', 'lepido_q_code', 'kind', 'name')}
+                    writer.writerow([section, key, entry.get('name', ''), json.dumps(details)])
+    else:
+        with open(report_path, 'w') as report_file:
+            json.dump(dict(sections, generated_at=datetime.datetime.now().isoformat(), counters=metrics.snapshot()['counters']),
+                      report_file, indent=2)
+
+def new_run_report() -> Dict[str, List[Dict[str, Any]]]:
+    return {'missing_lepido_ids': [], 'duplicate_lepidoptera': [], 'disambiguations': [], 'pending_edits': []}
+
+def state_namespace(args) -> Optional[str]:
+    # Runs against a stand-in server or a cassette get their own lookup cache, catalogue snapshot and progress journal:
+    # their identifiers and progress have nothing to do with Wikidata's, and must never be used by a live run
+    if args.standin:
+        return 'standin-' + re.sub(r'[^A-Za-z0-9]+', '-', urlparse(args.standin).netloc).strip('-')
+    if args.http_mode != MODE_LIVE:
+        return 'cassette-' + os.path.splitext(os.path.basename(args.cassette or 'default'))[0]
+    return None
+
+def namespaced_path(path: str, namespace: str) -> str:
+    # lookup_cache.sqlite3 -> lookup_cache.standin-127-0-0-1-8000.sqlite3
+    root, extension = os.path.splitext(path)
+    return f'{root}.{namespace}{extension}'
+
+def build_http_client(args) -> HttpClient:
+    return HttpClient(mode=args.http_mode, cassette_path=args.cassette, user_agent=USER_AGENT, timeouts=HTTP_TIMEOUTS)
+
+def build_sparql_client(args, http_client: HttpClient, metrics: RunMetrics, share: int = 1) -> SparqlClient:
+    # share: number of processes sending queries (see --workers), the rate limits are split between them
+    return SparqlClient(WIKIDATA_SPARQL_ENDPOINT,
+                        max_queries_per_second=SPARQL_MAX_QUERIES_PER_SECOND / share,
+                        max_concurrent_queries=max(1, SPARQL_MAX_CONCURRENT_QUERIES // share),
+                        timeout_budget=SPARQL_QUERY_TIMEOUT_BUDGET,
+                        rate_limited=SPARQL_QUERY_THROTTLING and args.http_mode != MODE_REPLAY,
+                        http_client=http_client,
+                        metrics=metrics)
+
+def build_lookup_cache(path: Optional[str]) -> Optional[LookupCache]:
+    if not path:
+        return None
+    return LookupCache(path,
+                       found_ttl=LOOKUP_CACHE_FOUND_TTL,
+                       not_found_ttl=LOOKUP_CACHE_NOT_FOUND_TTL,
+                       multiple_ttl=LOOKUP_CACHE_MULTIPLE_TTL,
+                       max_entries=LOOKUP_CACHE_MAX_ENTRIES)
+
+def main(args):
+    global edit_plan_file
+
+    if args.mode == 'apply':
+        logger.info(f"Applying edit plan from {args.plan_file}")
+        try:
+            apply_edit_plan(args.plan_file)
+        except TestModeCompleted:
+            logger.info("We'll stop here because we're in test mode.")
+    elif args.mode == 'plan':
+        with open(args.plan_file, 'a' if args.resume else 'w') as edit_plan_file:
+            import_catalogue(args)
+        edit_plan_file = None
+        logger.info(f"Edit plan written to {args.plan_file}")
+    elif args.mode == 'report':
+        import_catalogue(args)
+        write_report(args.report_file)
+        logger.info(f"Report written to {args.report_file}")
+    else:
+        import_catalogue(args)
+
+    if args.unmatched_report and args.mode != 'apply':
+        write_unmatched_plants_report(args.unmatched_report)
+        logger.info(f"Unmatched plants written to {args.unmatched_report}")
+
     logger.info("done.")
 
-    stats_str = f"""Stats: {synonym_counter} skipped synonyms, {no_hostplant_data_counter} species skipped because we don't have hostplant data, {accepted_counter} accepted species parsed.
-    {species_not_found_counter} species not found @Wikidata.
-    For {duplicate_entries_counter} species, multiple entries were found @Wikidata.
-    Identified {possible_missing_id} possible cases of missing P5862 property @Wikidata.
-    Host plants: {len(unmatched_plants_set)} not found @Wikidata, {duplicate_hp_entries_counter} found with duplicates
+    stats_str = f"""Stats: {metrics['synonyms']} skipped synonyms, {metrics['no_hostplant_data']} species skipped because we don't have hostplant data, {metrics['accepted_species']} accepted species parsed.
+    {metrics['species_not_found']} species not found @Wikidata.
+    For {metrics['duplicate_species_entries']} species, multiple entries were found @Wikidata.
+    Identified {metrics['possible_missing_ids']} possible cases of missing P5862 property @Wikidata.
+    Host plants: {len(metrics.unmatched_plants)} not found @Wikidata, {metrics['duplicate_hostplant_entries']} found with duplicates
+    {metrics['unresolved_hostplants']} lepidoptera skipped because none of their host plants were found @Wikidata.
+    {metrics['disambiguated_entries']} multiple matches settled with the taxonomic context.
+    {metrics['already_synchronized']} lepidoptera already synchronized (not fetched).
+    {metrics['revision_checks']} lepidoptera revisions checked, {metrics['edited_items']} edited @Wikidata since the last run.
 
-    {editions_counter} editions performed @Wikidata.
+    {metrics['editions']} editions {'performed' if args.mode in ('run', 'apply') else 'planned'} @Wikidata.
     """
+    if lookup_cache is not None:
+        stats_str = stats_str + f"Lookup cache: {lookup_cache.hits + metrics['shard_lookup_cache_hits']} hits, {lookup_cache.misses + metrics['shard_lookup_cache_misses']} misses.\n    "
+    stats_str = stats_str + f"SPARQL: {sparql_client.queries_count + metrics['shard_sparql_queries']} queries sent, {sparql_client.retries_count} retries.\n"
+    connection_stats = http_client.connection_stats()
+    stats_str = stats_str + f"    HTTP: {connection_stats['requests']} requests, {connection_stats['connections']} connections opened, {connection_stats['circuit_breaks']} circuit breaks.\n"
+    for stage, latency in sorted(metrics.snapshot()['latencies'].items()):
+        stats_str = stats_str + f"    {stage}: {latency['count']} calls, {latency['sum']:.1f}s total, p50 {latency['p50']:.3f}s, p95 {latency['p95']:.3f}s\n"
     print(stats_str)
 
 
 if __name__ == "__main__":
-    synonym_counter = 0
-    accepted_counter = 0
-    species_not_found_counter = 0
-    duplicate_entries_counter = 0
-    possible_missing_id = 0
-    no_hostplant_data_counter = 0
-
-    duplicate_hp_entries_counter = 0
+    parser = argparse.ArgumentParser(description="Import host plant data from the Catalogue of Lepidoptera of Belgium to Wikidata.")
+    parser.add_argument('mode', nargs='?', choices=('run', 'plan', 'apply', 'report'), default='run',
+                        help="run: synchronize directly (default). plan: only compute the edits and write them to the plan file. "
+                             "apply: submit the edits of a plan file. report: read-only, list the species without P5862, "
+                             "the unmatched plants and the pending edits in the report file (no credentials needed).")
+    parser.add_argument('--plan-file', default=EDIT_PLAN_PATH, help=f"Edit plan file (JSONL), default: {EDIT_PLAN_PATH}")
+    parser.add_argument('--report-file', default=REPORT_PATH, help=f"Report file (.json or .csv), default: {REPORT_PATH}")
+    parser.add_argument('--resume', action='store_true', help="Resume an interrupted run, skipping the work it already completed")
+    parser.add_argument('--checkpoint-file', default=CHECKPOINT_PATH, help=f"Progress journal, default: {CHECKPOINT_PATH}")
+    parser.add_argument('--http-mode', choices=HTTP_MODES, default=MODE_LIVE,
+                        help="record: save all HTTP interactions to the cassette file. replay: answer from the cassette file, offline.")
+    parser.add_argument('--cassette', help="Cassette file, for the record and replay HTTP modes")
+    parser.add_argument('--standin', metavar='URL',
+                        help="Use a local stand-in server (see standin_server.py) for the catalogue, SPARQL and Wikibase API")
+    parser.add_argument('--metrics-file', help="Periodically export the run metrics (counters, latencies, ...) to this file")
+    parser.add_argument('--metrics-format', choices=(FORMAT_JSON, FORMAT_PROMETHEUS), default=FORMAT_JSON)
+    parser.add_argument('--profile', metavar='FILE',
+                        help="Profile the run: write the sampled stacks (collapsed format, for flamegraph.pl or speedscope) "
+                             "to this file, and print a summary of the time spent running vs waiting, per thread and function")
+    parser.add_argument('--dump-index', help="Resolve identifiers and read entities from this dump index (see dump_index.py) "
+                                             "instead of SPARQL and wbgetentities: only the edits go to the network")
+    parser.add_argument('--plant-index', help="Resolve the host plants from this plant name index (see plant_name_index.py), "
+                                              "tolerating authorship strings, hybrid signs and spelling variants")
+    parser.add_argument('--unmatched-report', metavar='CSV',
+                        help="Write the host plants not found @Wikidata to this file, with candidates from the plant name index")
+    parser.add_argument('--two-pass', action='store_true',
+                        help="Read the whole catalogue first, and resolve all its lepido IDs and distinct host plant names "
+                             "at once (fuller SPARQL batches, the most cited plants first) before updating Wikidata")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only process the species that changed in the catalogue since the last run")
+    parser.add_argument('--track-revisions', action='store_true',
+                        help="With --incremental, also process again the lepidoptera items that were edited @Wikidata since the "
+                             "last run (their revision id changed), to restore removed claims or references")
+    parser.add_argument('--recent-changes', metavar='JSONL',
+                        help="With --track-revisions, take the current revision ids from this recent changes feed "
+                             "(recentchanges API entries or EventStreams events, one per line) instead of asking Wikidata")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Shard the read phase (lookups, reading and comparing the items) of the run, plan and report modes "
+                             "across this many processes. Edits are still submitted by this process only.")
+    args = parser.parse_args()
+    if args.workers > 1 and args.http_mode != MODE_LIVE:
+        parser.error("--workers can't be used with the record and replay HTTP modes")
+    if (args.track_revisions or args.recent_changes) and not args.incremental:
+        parser.error("--track-revisions and --recent-changes need --incremental")
 
-    editions_counter = 0
+    if args.standin:
+        CATALOGUE_SPECIES_DETAILS_ENDPOINT = args.standin + standin_server.CATALOGUE_PATH
+        WIKIDATA_SPARQL_ENDPOINT = args.standin + standin_server.SPARQL_PATH
+        WIKIBASE_API_ENDPOINT = args.standin + standin_server.API_PATH
 
-    unmatched_plants_set = set()
+    metrics = RunMetrics()
 
     logger = logging.getLogger(__name__)
     coloredlogs.install(level=LOGLEVEL)
 
-    site = pywikibot.Site("wikidata", "wikidata")
-    repo = site.data_repository()
+    namespace = state_namespace(args)
+    if namespace is not None:
+        LOOKUP_CACHE_PATH = namespaced_path(LOOKUP_CACHE_PATH, namespace) if LOOKUP_CACHE_PATH else None
+        CATALOGUE_SNAPSHOT_PATH = namespaced_path(CATALOGUE_SNAPSHOT_PATH, namespace)
+        if args.checkpoint_file == CHECKPOINT_PATH:
+            args.checkpoint_file = namespaced_path(CHECKPOINT_PATH, namespace)
+        logger.info(f"Not a live run: using separate state files ({namespace})")
+
+    lepido_id_index = None
+    host_claims_index = None
+    # The report mode doesn't leave any trace: no progress journal, no catalogue snapshot
+    read_only = args.mode == 'report'
+    run_report = new_run_report() if read_only else None
+    incremental_sync = args.incremental and not read_only
+    two_pass = args.two_pass
+    track_revisions = incremental_sync and (args.track_revisions or args.recent_changes is not None)
+    recent_changes = load_recent_changes(args.recent_changes) if args.recent_changes else None
+    catalogue_snapshot = CatalogueSnapshot(CATALOGUE_SNAPSHOT_PATH) if not read_only else None
+    # A plan may never be applied: only the runs that edit move the snapshot forward (the plan mode still uses it)
+    snapshot_updates = args.mode == 'run'
+    dump_index = DumpIndex(args.dump_index) if args.dump_index else None
+    plant_name_index = PlantNameIndex(args.plant_index) if args.plant_index else None
+    edit_plan_file = None
+    checkpoint_journal = CheckpointJournal(args.checkpoint_file if not read_only else None, resume=args.resume)
+
+    http_client = build_http_client(args)
+    # The coordinator of a sharded run (--workers) only sends the prefetch queries, before the workers start
+    sparql_client = build_sparql_client(args, http_client, metrics)
+
+    lookup_cache = build_lookup_cache(LOOKUP_CACHE_PATH)
+    if lookup_cache is not None:
+        metrics.register_gauge('lookup_cache_hits', lambda: lookup_cache.hits)
+        metrics.register_gauge('lookup_cache_misses', lambda: lookup_cache.misses)
+        metrics.register_gauge('lookup_cache_hit_ratio',
+                               lambda: lookup_cache.hits / (lookup_cache.hits + lookup_cache.misses) if lookup_cache.hits + lookup_cache.misses else None)
+    metrics.register_gauge('sparql_queries', lambda: sparql_client.queries_count)
+    metrics.register_gauge('sparql_retries', lambda: sparql_client.retries_count)
+    metrics.register_gauge('http_requests', lambda: http_client.connection_stats()['requests'])
+    metrics.register_gauge('http_connections_opened', lambda: http_client.connection_stats()['connections'])
+    metrics.register_gauge('http_connection_reuse_ratio', lambda: http_client.connection_stats()['reuse_ratio'])
+    metrics.register_gauge('http_circuit_breaks', lambda: http_client.connection_stats()['circuit_breaks'])
+    if args.metrics_file:
+        metrics.start_exporter(args.metrics_file, args.metrics_format, interval=METRICS_EXPORT_INTERVAL)
+
+    edit_executor = None
+    edited_item_states = {}  # type: Dict[str, Dict[str, Any]]
+    if args.mode in ('run', 'apply'):
+        edit_executor = EditExecutor(queue_size=EDIT_QUEUE_SIZE, metrics=metrics)
+        metrics.register_gauge('edit_queue_depth', edit_executor.pending)
+        metrics.register_gauge('edit_maxlag_pauses', lambda: edit_executor.maxlag_count)
+
+    repo = None
+    if args.mode in ('run', 'apply') and not args.standin:  # No need to log in if we don't write anything (to Wikidata)
+        import pywikibot  # Slow: loads user-config.py
+        site = pywikibot.Site("wikidata", "wikidata")
+        repo = site.data_repository()
     
-    main()
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler(interval=PROFILE_SAMPLING_INTERVAL)
+        profiler.start()
+
+    try:
+        main(args)
+    finally:
+        if edit_executor is not None:
+            edit_executor.close()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write_collapsed(args.profile)
+            print(profiler.summary(top=PROFILE_TOP_FUNCTIONS))
+            logger.info(f"Profile written to {args.profile}")
+        metrics.stop(args.metrics_file, args.metrics_format)
+        http_client.close()
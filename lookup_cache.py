@@ -0,0 +1,132 @@
+# -*- coding: utf-8  -*-
+import json
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Outcomes of a lookup, each of them having its own time to live
+OUTCOME_FOUND = 'found'
+OUTCOME_NOT_FOUND = 'not_found'
+OUTCOME_MULTIPLE = 'multiple'
+
+DAY = 24 * 60 * 60
+
+
+def lookup_outcome(q_codes: List[str]) -> str:
+    if len(q_codes) == 1:
+        return OUTCOME_FOUND
+    elif len(q_codes) == 0:
+        return OUTCOME_NOT_FOUND
+    else:
+        return OUTCOME_MULTIPLE
+
+
+class LookupCache(object):
+    # Persistent (SQLite) cache for the results of Wikidata identifiers lookups, keyed by (lookup kind, value).
+    #
+    # Contrary to functools.lru_cache, it survives between runs and also remembers lookups that didn't
+    # return exactly one match, so unmatched plants are not searched again and again.
+    # When the cache grows above max_entries, the least recently used entries are evicted.
+    #
+    # It also keeps how multiple matches were disambiguated (see taxon_disambiguation.py): the chosen Q identifier
+    # (or none) and why, valid as long as the lookup returns the same candidates.
+
+    def __init__(self, path: str, found_ttl: float = 30 * DAY, not_found_ttl: float = 7 * DAY,
+                 multiple_ttl: float = 7 * DAY, max_entries: int = 200000):
+        self.ttls = {OUTCOME_FOUND: found_ttl, OUTCOME_NOT_FOUND: not_found_ttl, OUTCOME_MULTIPLE: multiple_ttl}
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        # Shared by the worker processes of a sharded run: concurrent readers, and writers waiting for each other
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS lookups (
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            q_codes TEXT NOT NULL,
+            stored_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            PRIMARY KEY (kind, value))''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS lookups_last_used_at ON lookups (last_used_at)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS disambiguations (
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            candidates TEXT NOT NULL,
+            chosen TEXT,
+            rationale TEXT NOT NULL,
+            stored_at REAL NOT NULL,
+            PRIMARY KEY (kind, value))''')
+        self.connection.commit()
+
+    def get_many(self, kind: str, values: Iterable[str]) -> Dict[str, List[str]]:
+        # Returns the (non-expired) cached Q identifiers for the given values. Values that are missing from the
+        # cache (or expired) are not present in the returned dict.
+        now = time.time()
+        found = {}
+
+        values = list(values)
+        for i in range(0, len(values), 500):  # Keep below SQLite's maximum number of host parameters
+            batch = values[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT value, outcome, q_codes, stored_at FROM lookups WHERE kind = ? AND value IN ({','.join('?' * len(batch))})",
+                [kind] + batch)
+            for value, outcome, q_codes, stored_at in rows:
+                if now - stored_at <= self.ttls[outcome]:
+                    found[value] = json.loads(q_codes)
+
+        if found:
+            self.connection.executemany('UPDATE lookups SET last_used_at = ? WHERE kind = ? AND value = ?',
+                                        [(now, kind, value) for value in found])
+            self.connection.commit()
+
+        self.hits = self.hits + len(found)
+        self.misses = self.misses + len(values) - len(found)
+        return found
+
+    def put_many(self, kind: str, results: Dict[str, List[str]]):
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO lookups (kind, value, outcome, q_codes, stored_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)',
+            [(kind, value, lookup_outcome(q_codes), json.dumps(q_codes), now, now) for value, q_codes in results.items()])
+        self.connection.commit()
+        self.evict()
+
+    def get_disambiguations(self, kind: str, candidates: Dict[str, List[str]]) -> Dict[str, Tuple[Optional[str], str]]:
+        # value -> (chosen Q identifier or None, rationale), for the values disambiguated earlier with the same candidates
+        now = time.time()
+        found = {}
+
+        values = list(candidates)
+        for i in range(0, len(values), 500):
+            batch = values[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT value, candidates, chosen, rationale, stored_at FROM disambiguations WHERE kind = ? AND value IN ({','.join('?' * len(batch))})",
+                [kind] + batch)
+            for value, stored_candidates, chosen, rationale, stored_at in rows:
+                ttl = self.ttls[OUTCOME_FOUND if chosen else OUTCOME_MULTIPLE]
+                if now - stored_at <= ttl and json.loads(stored_candidates) == sorted(candidates[value]):
+                    found[value] = (chosen, rationale)
+        return found
+
+    def put_disambiguations(self, kind: str, decisions: Dict[str, Tuple[List[str], Optional[str], str]]):
+        # value -> (candidates, chosen Q identifier or None, rationale)
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO disambiguations (kind, value, candidates, chosen, rationale, stored_at) VALUES (?, ?, ?, ?, ?, ?)',
+            [(kind, value, json.dumps(sorted(candidates)), chosen, rationale, now) for value, (candidates, chosen, rationale) in decisions.items()])
+        self.connection.commit()
+
+    def evict(self):
+        # Remove the least recently used entries above max_entries
+        count = self.connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                'DELETE FROM lookups WHERE rowid IN (SELECT rowid FROM lookups ORDER BY last_used_at LIMIT ?)',
+                (count - self.max_entries,))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
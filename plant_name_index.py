@@ -0,0 +1,202 @@
+# -*- coding: utf-8  -*-
+# Local index of the plant taxon names (P225) of Wikidata, to resolve the host plants of the catalogue without
+# network calls, even when the catalogue spelling differs from the Wikidata one (authorship strings, hybrid signs,
+# "agg.", case or whitespace differences), and to suggest candidates for the names that still don't match.
+#
+# Build: $ python plant_name_index.py plant_names.sqlite3
+import argparse
+import logging
+import re
+import sqlite3
+import unicodedata
+from typing import Dict, Iterable, List, Set, Tuple
+
+from sparql_client import SparqlClient
+
+logger = logging.getLogger(__name__)
+
+WIKIDATA_SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
+TAXON_RANK_PROPERTY_ID = 'P105'
+TAXON_NAME_PROPERTY_ID = 'P225'
+SPECIES_VALUE_ID = 'Q7432'
+GENUS_VALUE_ID = 'Q34740'
+
+# Walking the P171 (parent taxon) tree down from Plantae times out on WDQS, so the export selects the taxa with
+# an IPNI plant ID instead: that covers the vascular plants, which are the host plants of the catalogue.
+PLANT_TAXA_PROPERTY_ID = 'P961'
+EXPORT_PAGE_SIZE = 50000
+
+# Words that qualify a name without being part of it
+QUALIFIER_WORDS = ('agg.', 'agg', 'aggr.', 's.l.', 's.lat.', 's.str.', 's.s.', 'sensu', 'lato', 'stricto', 'sp.', 'spp.', 'cf.', 'aff.')
+INFRASPECIFIC_MARKERS = {'subsp.': 'subsp.', 'ssp.': 'subsp.', 'var.': 'var.', 'f.': 'f.', 'forma': 'f.'}
+HYBRID_SIGNS = ('×', '✕', '⨯')
+
+CANDIDATES_SHORTLIST_SIZE = 50  # Names (sharing the most trigrams) for which the edit distance is computed
+
+
+def normalized_name(name: str) -> str:
+    # Key under which the catalogue and Wikidata spellings of a name should meet: lowercase genus, epithet and
+    # infraspecific epithet, without authorship, hybrid signs and qualifiers
+    name = unicodedata.normalize('NFKC', name)
+    for sign in HYBRID_SIGNS:
+        name = name.replace(sign, ' ')
+
+    words = []
+    tokens = name.split()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        lowered = token.lower()
+        if lowered in QUALIFIER_WORDS or (lowered == 'x' and words):
+            pass
+        elif not words:
+            words.append(lowered)  # Genus
+        elif lowered in INFRASPECIFIC_MARKERS and len(words) >= 2 and i + 1 < len(tokens):
+            words.append(INFRASPECIFIC_MARKERS[lowered])
+            words.append(tokens[i + 1].lower())
+            i = i + 1
+        elif token[0].isupper() or token[0] in '(&,' or token[0].isdigit() or (len(words) >= 2 and token.endswith('.')):
+            # Authorship (L., (L.) Mill., DC., Ehrh. ex Willd., ...): skip it, but keep what might follow it
+            pass
+        elif len(words) == 1 and re.match(r"^[a-z][a-z\-]*$", lowered):
+            words.append(lowered)  # Species epithet
+        i = i + 1
+
+    return ' '.join(words)
+
+
+def trigrams(value: str) -> Set[str]:
+    padded = f'  {value} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, character_a in enumerate(a, 1):
+        current = [i]
+        for j, character_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (character_a != character_b)))
+        previous = current
+    return previous[-1]
+
+
+def similarity(a: str, b: str) -> float:
+    if not a and not b:
+        return 1.0
+    return 1 - edit_distance(a, b) / max(len(a), len(b))
+
+
+def plant_taxa_export_query(offset: int, limit: int) -> str:
+    return f'''SELECT ?item ?name ?rank WHERE {{
+        VALUES ?rank {{ wd:{SPECIES_VALUE_ID} wd:{GENUS_VALUE_ID} }}
+        ?item wdt:{PLANT_TAXA_PROPERTY_ID} ?plant_id;
+        wdt:{TAXON_NAME_PROPERTY_ID} ?name;
+        wdt:{TAXON_RANK_PROPERTY_ID} ?rank.
+        }} ORDER BY ?item ?name LIMIT {limit} OFFSET {offset}'''
+
+
+class PlantNameIndex(object):
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS plant_taxa (name TEXT NOT NULL, normalized TEXT NOT NULL, rank TEXT NOT NULL, q_code TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS plant_taxa_name_rank ON plant_taxa (name, rank);
+            CREATE INDEX IF NOT EXISTS plant_taxa_normalized_rank ON plant_taxa (normalized, rank);
+        ''')
+
+        # Trigram -> normalized names, per rank. Only built when candidates are needed.
+        self.trigram_indexes = {}  # type: Dict[str, Dict[str, Set[str]]]
+
+    def build(self, sparql_client: SparqlClient, page_size: int = EXPORT_PAGE_SIZE):
+        self.connection.execute('DELETE FROM plant_taxa')
+
+        offset = 0
+        while True:
+            bindings = sparql_client.query(plant_taxa_export_query(offset, page_size))
+            rows = []
+            for binding in bindings:
+                name = binding['name']['value']
+                rows.append((name, normalized_name(name),
+                             binding['rank']['value'].rsplit('/', 1)[-1], binding['item']['value'].rsplit('/', 1)[-1]))
+            self.connection.executemany('INSERT INTO plant_taxa (name, normalized, rank, q_code) VALUES (?, ?, ?, ?)', rows)
+            self.connection.commit()
+            logger.info(f'{offset + len(bindings)} plant taxa exported...')
+
+            if len(bindings) < page_size:
+                break
+            offset = offset + page_size
+
+        self.trigram_indexes = {}
+        logger.info('Done.')
+
+    def _select(self, column: str, values: List[str], rank: str) -> Dict[str, List[str]]:
+        results = {}  # type: Dict[str, List[str]]
+        for i in range(0, len(values), 500):
+            batch = values[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT {column}, q_code FROM plant_taxa WHERE rank = ? AND {column} IN ({','.join('?' * len(batch))}) ORDER BY q_code",
+                [rank] + batch)
+            for value, q_code in rows:
+                q_codes = results.setdefault(value, [])
+                if q_code not in q_codes:
+                    q_codes.append(q_code)
+        return results
+
+    def lookup(self, names: Iterable[str], rank: str) -> Dict[str, List[str]]:
+        # Exact name first, then normalized name. Names unknown to the index get an empty list.
+        names = sorted(set(names))
+        results = self._select('name', names, rank)
+
+        not_found = {name: normalized_name(name) for name in names if name not in results}
+        by_normalized_name = self._select('normalized', sorted(set(not_found.values())), rank)
+        for name, key in not_found.items():
+            results[name] = by_normalized_name.get(key, [])
+        return results
+
+    def _trigram_index(self, rank: str) -> Dict[str, Set[str]]:
+        if rank not in self.trigram_indexes:
+            index = {}  # type: Dict[str, Set[str]]
+            for (normalized,) in self.connection.execute('SELECT DISTINCT normalized FROM plant_taxa WHERE rank = ?', (rank,)):
+                for trigram in trigrams(normalized):
+                    index.setdefault(trigram, set()).add(normalized)
+            self.trigram_indexes[rank] = index
+        return self.trigram_indexes[rank]
+
+    def candidates(self, name: str, rank: str, limit: int = 5) -> List[Tuple[str, str, float]]:
+        # Closest names of the index: (name, Q identifier, similarity), best first. The names sharing the most
+        # trigrams with ours are shortlisted, then ranked by edit distance.
+        key = normalized_name(name)
+        index = self._trigram_index(rank)
+
+        shared = {}  # type: Dict[str, int]
+        for trigram in trigrams(key):
+            for normalized in index.get(trigram, ()):
+                shared[normalized] = shared.get(normalized, 0) + 1
+        shortlist = sorted(shared, key=lambda normalized: (-shared[normalized], normalized))[:CANDIDATES_SHORTLIST_SIZE]
+        ranked = sorted(((similarity(key, normalized), normalized) for normalized in shortlist), key=lambda candidate: (-candidate[0], candidate[1]))
+
+        candidates = []  # type: List[Tuple[str, str, float]]
+        for score, normalized in ranked:
+            for name, q_code in self.connection.execute(
+                    'SELECT name, q_code FROM plant_taxa WHERE rank = ? AND normalized = ? ORDER BY name, q_code', (rank, normalized)):
+                candidates.append((name, q_code, round(score, 3)))
+            if len(candidates) >= limit:
+                break
+        return candidates[:limit]
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the plant taxa of Wikidata to the index used by the --plant-index option of the bots.")
+    parser.add_argument('index', help="Index file to create (SQLite)")
+    parser.add_argument('--sparql-endpoint', default=WIKIDATA_SPARQL_ENDPOINT)
+    parser.add_argument('--page-size', type=int, default=EXPORT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    index = PlantNameIndex(args.index)
+    index.build(SparqlClient(args.sparql_endpoint, max_concurrent_queries=1), page_size=args.page_size)
+    index.close()
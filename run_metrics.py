@@ -0,0 +1,168 @@
+# -*- coding: utf-8  -*-
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Upper bounds (in seconds) of the latency histograms buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+FORMAT_JSON = 'json'
+FORMAT_PROMETHEUS = 'prometheus'
+
+METRICS_PREFIX = 'lepido_hostplant_bot'
+
+
+class LatencyHistogram(object):
+    # Cumulative buckets (for Prometheus) + a bounded sample of the last observations (for the quantiles)
+
+    def __init__(self, max_samples: int = 10000):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = []  # type: List[float]
+        self.max_samples = max_samples
+
+    def observe(self, value: float):
+        self.count = self.count + 1
+        self.sum = self.sum + value
+        for i in range(bisect.bisect_left(LATENCY_BUCKETS, value), len(LATENCY_BUCKETS)):
+            self.bucket_counts[i] = self.bucket_counts[i] + 1
+        self.samples.append(value)
+        if len(self.samples) > self.max_samples:
+            del self.samples[:len(self.samples) - self.max_samples]
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def to_dict(self) -> Dict[str, Optional[float]]:
+        return {'count': self.count,
+                'sum': round(self.sum, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else None,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'max': max(self.samples) if self.samples else None}
+
+
+class RunMetrics(object):
+    # State of a run: counters, unmatched plants, latency histograms (per stage) and gauges (computed on export,
+    # such as cache hit ratios). Can be exported periodically (JSON or Prometheus text format) to a file, to follow
+    # a long run while it's in progress.
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = {}  # type: Dict[str, int]
+        self.histograms = {}  # type: Dict[str, LatencyHistogram]
+        self.gauges = {}  # type: Dict[str, Callable[[], Optional[float]]]
+        self.unmatched_plants = {}  # type: Dict[Tuple[str, str], int]  # (lookup kind, name) -> number of lepidoptera
+        self.lock = threading.Lock()
+
+        self.exporter = None  # type: Optional[threading.Thread]
+        self.stop_exporter = threading.Event()
+
+    def increment(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def __getitem__(self, name: str) -> int:
+        return self.counters.get(name, 0)
+
+    def observe(self, stage: str, duration: float):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = LatencyHistogram()
+            self.histograms[stage].observe(duration)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def drain(self) -> Dict:
+        # What was counted since the last call, and reset: used by the worker processes of a sharded run, whose
+        # counts are merged by the coordinator (see merge())
+        with self.lock:
+            state = {'counters': self.counters,
+                     'unmatched_plants': self.unmatched_plants,
+                     'observations': {stage: histogram.samples for stage, histogram in self.histograms.items()}}
+            self.counters = {}
+            self.unmatched_plants = {}
+            self.histograms = {}
+        return state
+
+    def merge(self, state: Dict):
+        for name, value in state['counters'].items():
+            self.increment(name, value)
+        for key, count in state['unmatched_plants'].items():
+            self.unmatched_plants[key] = self.unmatched_plants.get(key, 0) + count
+        for stage, durations in state['observations'].items():
+            for duration in durations:
+                self.observe(stage, duration)
+
+    def register_gauge(self, name: str, function: Callable[[], Optional[float]]):
+        self.gauges[name] = function
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            gauges = {}
+            for name, function in self.gauges.items():
+                gauges[name] = function()
+            gauges['unmatched_plants'] = len(self.unmatched_plants)
+
+            return {'timestamp': time.time(),
+                    'elapsed_seconds': round(time.time() - self.started_at, 3),
+                    'counters': dict(self.counters),
+                    'gauges': gauges,
+                    'latencies': {stage: histogram.to_dict() for stage, histogram in self.histograms.items()}}
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = [f'{METRICS_PREFIX}_elapsed_seconds {snapshot["elapsed_seconds"]}']
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{METRICS_PREFIX}_{name}_total {value}')
+        for name, value in sorted(snapshot['gauges'].items()):
+            if value is not None:
+                lines.append(f'{METRICS_PREFIX}_{name} {value}')
+
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                metric = f'{METRICS_PREFIX}_{stage}_duration_seconds'
+                lines.append(f'# TYPE {metric} histogram')
+                for upper_bound, count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                    lines.append(f'{metric}_bucket{{le="{upper_bound}"}} {count}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum {histogram.sum}')
+                lines.append(f'{metric}_count {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str, format: str = FORMAT_JSON):
+        content = self.to_prometheus() if format == FORMAT_PROMETHEUS else json.dumps(self.snapshot(), indent=2)
+        # Write then rename, so readers never see a partial file
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(path + '.tmp', path)
+
+    def start_exporter(self, path: str, format: str = FORMAT_JSON, interval: float = 30):
+        def export_periodically():
+            while not self.stop_exporter.wait(interval):
+                self.export(path, format)
+
+        self.exporter = threading.Thread(target=export_periodically, name='metrics-exporter', daemon=True)
+        self.exporter.start()
+
+    def stop(self, path: Optional[str] = None, format: str = FORMAT_JSON):
+        # Stop the periodic export, and do a last one
+        self.stop_exporter.set()
+        if self.exporter is not None:
+            self.exporter.join()
+        if path:
+            self.export(path, format)
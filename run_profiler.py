@@ -0,0 +1,140 @@
+# -*- coding: utf-8  -*-
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Thread states, as the root frame of the collapsed stacks
+RUNNING = 'cpu'
+WAITING = 'wait'
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Used to classify the samples when the CPU time of the threads isn't available (time.pthread_getcpuclockid() is
+# missing on some platforms): the innermost Python frames of blocking calls
+WAITING_FUNCTIONS = {'wait', 'sleep', 'acquire', 'get', 'join', 'select', 'poll', 'readinto', 'recv', 'recv_into',
+                     'accept', 'create_connection', '_wait_for_tstate_lock'}
+
+
+class SamplingProfiler(object):
+    # Low overhead sampling profiler: a thread takes the stacks of all the other threads every `interval` seconds.
+    #
+    # Each sample is classified as running (the thread used CPU since the previous sample) or waiting (sleeping,
+    # blocked on I/O, on a lock or a queue), so the time spent waiting on the services is told apart from the CPU
+    # work. Stacks are aggregated in the collapsed format of flamegraph.pl / speedscope
+    # ("state;thread;outer frame;...;inner frame count").
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = {}  # type: Dict[Tuple[str, ...], int]
+        self.samples_count = 0
+        self.labels = {}  # code object -> frame label
+        self.project_frames = set()  # Labels of the functions of this project
+
+        self.stop_event = threading.Event()
+        self.thread = None  # type: Optional[threading.Thread]
+        self.cpu_times = {}  # type: Dict[int, float]  # thread ident -> CPU time at the previous sample
+        self.started_at = None  # type: Optional[float]
+        self.started_cpu_time = None  # type: Optional[float]
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.started_cpu_time = time.process_time()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.wall_time = time.perf_counter() - self.started_at
+        self.cpu_time = time.process_time() - self.started_cpu_time
+
+    def _frame_label(self, code) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            self.labels[code] = label
+            if code.co_filename.startswith(PROJECT_DIRECTORY):
+                self.project_frames.add(label)
+        return label
+
+    def _thread_state(self, ident: int, frame, elapsed: float) -> str:
+        try:
+            cpu_time = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            return WAITING if frame.f_code.co_name in WAITING_FUNCTIONS else RUNNING
+
+        previous = self.cpu_times.get(ident, cpu_time)
+        self.cpu_times[ident] = cpu_time
+        return RUNNING if cpu_time - previous >= elapsed / 2 else WAITING
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        last_sample_at = time.perf_counter()
+
+        while not self.stop_event.wait(self.interval):
+            now = time.perf_counter()
+            elapsed = now - last_sample_at
+            last_sample_at = now
+
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                state = self._thread_state(ident, frame, elapsed)
+
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame.f_code))
+                    frame = frame.f_back
+                key = (state, thread_names.get(ident, str(ident))) + tuple(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples_count = self.samples_count + 1
+
+    def write_collapsed(self, path: str):
+        with open(path, 'w') as collapsed_file:
+            for stack, count in sorted(self.stacks.items()):
+                collapsed_file.write(';'.join(frame.replace(';', ':') for frame in stack) + f' {count}\n')
+
+    def summary(self, top: int = 20) -> str:
+        # Time per thread (running vs waiting), then the functions of the project by inclusive time, then all
+        # functions by self time (innermost frame), the most expensive first
+        def seconds(count: int) -> str:
+            return f'{count * self.interval:.2f}s'
+
+        threads = {}  # type: Dict[str, Dict[str, int]]
+        inclusive = {}  # type: Dict[str, Dict[str, int]]
+        self_time = {}  # type: Dict[str, Dict[str, int]]
+        for (state, thread_name, *frames), count in self.stacks.items():
+            counts = threads.setdefault(thread_name, {RUNNING: 0, WAITING: 0})
+            counts[state] = counts[state] + count
+
+            for frame in set(frames):
+                if frame in self.project_frames:
+                    counts = inclusive.setdefault(frame, {RUNNING: 0, WAITING: 0})
+                    counts[state] = counts[state] + count
+            if frames:
+                counts = self_time.setdefault(frames[-1], {RUNNING: 0, WAITING: 0})
+                counts[state] = counts[state] + count
+
+        lines = [f'Profile: {self.wall_time:.2f}s wall time, {self.cpu_time:.2f}s CPU time (process), '
+                 f'{self.samples_count} samples every {self.interval * 1000:.0f}ms']
+        lines.append('  Threads (running / waiting):')
+        for thread_name, counts in sorted(threads.items(), key=lambda item: -sum(item[1].values())):
+            lines.append(f'    {thread_name}: {seconds(counts[RUNNING])} / {seconds(counts[WAITING])}')
+        for title, table in ((f'Top {top} project functions, inclusive (running / waiting):', inclusive),
+                             (f'Top {top} functions, self (running / waiting):', self_time)):
+            lines.append(f'  {title}')
+            for function, counts in self._top(table, top):
+                lines.append(f'    {seconds(counts[RUNNING])} / {seconds(counts[WAITING])}  {function}')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _top(table: Dict[str, Dict[str, int]], top: int) -> List[Tuple[str, Dict[str, int]]]:
+        return sorted(table.items(), key=lambda item: (-(item[1][RUNNING] + item[1][WAITING]), item[0]))[:top]
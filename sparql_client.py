@@ -0,0 +1,142 @@
+# -*- coding: utf-8  -*-
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from http_client import RETRYABLE_STATUS_CODES, HttpClient, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+
+class SparqlQueryFailed(Exception):
+    pass
+
+
+class TokenBucket(object):
+    # Thread-safe token bucket: acquire() blocks until a token is available. The refill rate adapts to the
+    # endpoint feedback: it is divided when we're throttled (429/503) and slowly increases back (up to max_rate)
+    # after each successful query.
+
+    def __init__(self, rate: float, capacity: float, min_rate: float = 0.2, max_rate: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        # Nobody gets a token for the next `seconds` (used to honour Retry-After)
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class SparqlClient(object):
+    # Client for the Wikidata Query Service.
+    #
+    # - queries are rate-limited by an (adaptive) token bucket, shared by all threads
+    # - throttled/failed queries are retried with exponential backoff and jitter, honouring Retry-After
+    # - each query has a total time budget (retries included), after which SparqlQueryFailed is raised
+    # - query_many() runs several queries concurrently, on a small pool of workers
+
+    def __init__(self, endpoint: str, max_queries_per_second: float = 5, max_concurrent_queries: int = 4,
+                 request_timeout: float = 65, timeout_budget: float = 300, max_backoff: float = 60,
+                 rate_limited: bool = True, http_client: Optional[HttpClient] = None, metrics=None):
+        self.endpoint = endpoint
+        self.http_client = http_client or HttpClient()
+        self.metrics = metrics  # Optional run_metrics.RunMetrics, to record the queries latencies
+        self.request_timeout = request_timeout
+        self.timeout_budget = timeout_budget
+        self.max_backoff = max_backoff
+
+        self.bucket = TokenBucket(rate=max_queries_per_second, capacity=max_concurrent_queries) if rate_limited else None
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_queries, thread_name_prefix='sparql')
+
+        self.queries_count = 0
+        self.retries_count = 0
+
+    def query(self, query: str) -> List[Dict[str, Any]]:
+        # Run the query and return its bindings
+        deadline = time.monotonic() + self.timeout_budget
+        attempt = 0
+
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise SparqlQueryFailed(f'Time budget exceeded for query: {query}')
+
+            retry_after = None
+            try:
+                self.queries_count = self.queries_count + 1
+                start = time.perf_counter()
+                response = self.http_client.get(self.endpoint, params={'query': query, 'format': 'json'},
+                                                timeout=min(self.request_timeout, remaining), check_status=False)
+                if self.metrics is not None:
+                    self.metrics.observe('sparql_query', time.perf_counter() - start)
+                if response.status_code == 200:
+                    if self.bucket is not None:
+                        self.bucket.speed_up()
+                    return response.json()['results']['bindings']
+                elif response.status_code not in RETRYABLE_STATUS_CODES:
+                    raise SparqlQueryFailed(f'SPARQL endpoint returned HTTP {response.status_code}: {response.text[:500]}')
+
+                logger.warning(f'SPARQL endpoint returned HTTP {response.status_code}, will retry.')
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if self.bucket is not None and response.status_code in (429, 503):
+                    self.bucket.slow_down()
+            except (requests.ConnectionError, requests.Timeout, ValueError) as e:  # ValueError: invalid JSON
+                logger.warning(f'SPARQL query failed ({e}), will retry.')
+
+            attempt = attempt + 1
+            self.retries_count = self.retries_count + 1
+            if retry_after is not None:
+                delay = retry_after
+                if self.bucket is not None:
+                    self.bucket.pause(retry_after)
+            else:
+                delay = random.uniform(0, min(self.max_backoff, 2 ** attempt))  # "Full jitter" backoff
+
+            if time.monotonic() + delay > deadline:
+                raise SparqlQueryFailed(f'Time budget exceeded for query: {query}')
+            time.sleep(delay)
+
+    def query_many(self, queries: List[str]) -> List[List[Dict[str, Any]]]:
+        # Run the queries concurrently, results are returned in the same order
+        if len(queries) <= 1:
+            return [self.query(query) for query in queries]
+        return list(self.executor.map(self.query, queries))
@@ -0,0 +1,445 @@
+# -*- coding: utf-8  -*-
+# Local stand-in for the services used by the bots: the catalogue of lepidoptera (JSON pagination), the Wikidata
+# Query Service (only the query shapes sent by the bots are understood) and the Wikibase API (wbgetentities,
+# wbeditentity). It allows to run and benchmark the bots offline and deterministically.
+#
+# Usage: $ python standin_server.py --catalogue catalogue.json --entities entities.json --sparql-latency 0.2
+import argparse
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+CATALOGUE_PATH = '/lepidoptera/all_species_details_json/'
+SPARQL_PATH = '/sparql'
+API_PATH = '/w/api.php'
+STATS_PATH = '/_stats'
+
+ENTITY_URI_PREFIX = 'http://www.wikidata.org/entity/'
+
+# Properties whose values are indexed for the SPARQL queries
+INDEXED_PROPERTIES = ('P105', 'P171', 'P225', 'P961', 'P5862')
+
+
+def truthy_claims(entity: Dict[str, Any], property_id: str) -> List[Dict[str, Any]]:
+    # Claims exposed as wdt: triples: the preferred ones if any, otherwise the normal ones
+    claims = entity.get('claims') or {}
+    claims = [claim for claim in claims.get(property_id, []) if claim.get('rank', 'normal') != 'deprecated']
+    preferred = [claim for claim in claims if claim.get('rank') == 'preferred']
+    return preferred or claims
+
+
+def snak_value(snak: Dict[str, Any]) -> Optional[str]:
+    # Value of a snak, as a string (Q identifier for items)
+    if 'datavalue' not in snak:
+        return None
+    value = snak['datavalue']['value']
+    if isinstance(value, dict):
+        return value.get('id')
+    return str(value)
+
+
+def literal_binding(value: str) -> Dict[str, str]:
+    return {'type': 'literal', 'value': value}
+
+
+def boolean_binding(value: bool) -> Dict[str, str]:
+    return {'type': 'literal', 'datatype': 'http://www.w3.org/2001/XMLSchema#boolean', 'value': 'true' if value else 'false'}
+
+
+def uri_binding(q_code: str) -> Dict[str, str]:
+    return {'type': 'uri', 'value': ENTITY_URI_PREFIX + q_code}
+
+
+class StandinWorld(object):
+    # State of the stand-in services: catalogue species and Wikidata entities (in the wbgetentities JSON format)
+
+    def __init__(self, catalogue: List[Dict[str, Any]], entities: Dict[str, Dict[str, Any]], catalogue_page_size: int = 100):
+        self.catalogue = catalogue
+        self.catalogue_page_size = catalogue_page_size
+        self.entities = entities
+        self.lock = threading.Lock()
+
+        self.last_revision_id = 1
+        for q_code, entity in self.entities.items():
+            entity.setdefault('id', q_code)
+            entity.setdefault('type', 'item')
+            entity.setdefault('claims', {})
+            self.last_revision_id = max(self.last_revision_id, entity.setdefault('lastrevid', self.last_revision_id + 1))
+
+        # (property id, value) -> items
+        self.index = {}  # type: Dict[Tuple[str, str], Set[str]]
+        for q_code, entity in self.entities.items():
+            self._index_entity(q_code, entity)
+
+    def _index_entity(self, q_code: str, entity: Dict[str, Any]):
+        for property_id in INDEXED_PROPERTIES:
+            for claim in truthy_claims(entity, property_id):
+                value = snak_value(claim['mainsnak'])
+                if value is not None:
+                    self.index.setdefault((property_id, value), set()).add(q_code)
+
+    def items_with(self, property_id: str, value: str) -> Set[str]:
+        return self.index.get((property_id, value), set())
+
+    def catalogue_page(self, page_num: int) -> Dict[str, Any]:
+        start = (page_num - 1) * self.catalogue_page_size
+        return {'page': page_num,
+                'results': self.catalogue[start:start + self.catalogue_page_size],
+                'hasMoreResults': start + self.catalogue_page_size < len(self.catalogue)}
+
+    def get_entities(self, q_codes: List[str], props: List[str]) -> Dict[str, Any]:
+        entities = {}
+        with self.lock:
+            for q_code in q_codes:
+                entity = self.entities.get(q_code)
+                if entity is None:
+                    entities[q_code] = {'id': q_code, 'missing': ''}
+                    continue
+
+                returned = {'id': q_code, 'type': entity['type']}
+                if 'info' in props:
+                    returned['lastrevid'] = entity['lastrevid']
+                for prop in props:
+                    if prop in entity:
+                        returned[prop] = json.loads(json.dumps(entity[prop]))  # Deep copy
+                entities[q_code] = returned
+        return {'entities': entities, 'success': 1}
+
+    def edit_entity(self, q_code: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            entity = self.entities.get(q_code)
+            if entity is None:
+                return {'error': {'code': 'no-such-entity', 'info': f'Could not find an entity with the ID "{q_code}".'}}
+
+            for claim in data.get('claims', []):
+                property_id = claim['mainsnak']['property']
+                property_claims = entity['claims'].setdefault(property_id, [])
+                if 'id' in claim:
+                    for i, existing_claim in enumerate(property_claims):
+                        if existing_claim.get('id') == claim['id']:
+                            property_claims[i] = claim
+                            break
+                    else:
+                        return {'error': {'code': 'invalid-guid', 'info': f'Claim {claim["id"]} not found.'}}
+                else:
+                    claim = dict(claim, id=f'{q_code}${uuid.uuid4()}')
+                    property_claims.append(claim)
+
+            self.last_revision_id = self.last_revision_id + 1
+            entity['lastrevid'] = self.last_revision_id
+            self._index_entity(q_code, entity)
+
+            return {'success': 1, 'entity': {'id': q_code, 'lastrevid': entity['lastrevid']}}
+
+
+# SPARQL: (regular expression, handler) for each query shape we understand. Handlers receive the world and the
+# match object, and return the bindings.
+SPARQL_HANDLERS = []  # type: List[Tuple[Any, Callable]]
+
+
+def sparql_handler(pattern: str):
+    def register(handler):
+        SPARQL_HANDLERS.append((re.compile(pattern, re.DOTALL), handler))
+        return handler
+    return register
+
+
+def parse_values(values_str: str) -> List[str]:
+    return [json.loads(value) for value in re.findall(r'"(?:[^"\\]|\\.)*"', values_str)]
+
+
+def paginate(bindings: List[Dict[str, Any]], query: str) -> List[Dict[str, Any]]:
+    limit = re.search(r'LIMIT (\d+)', query)
+    offset = re.search(r'OFFSET (\d+)', query)
+    start = int(offset.group(1)) if offset else 0
+    return bindings[start:start + int(limit.group(1))] if limit else bindings[start:]
+
+
+@sparql_handler(r'SELECT \?value \?item WHERE \{\s*VALUES \?value \{(?P<values>.*?)\}\s*'
+                r'\?item wdt:(?P<property>P\d+) \?value;\s*wdt:P105 wd:(?P<rank>Q\d+)\.\s*\}')
+def batch_lookup(world: StandinWorld, match, query: str) -> List[Dict[str, Any]]:
+    bindings = []
+    for value in parse_values(match.group('values')):
+        for q_code in sorted(world.items_with(match.group('property'), value) & world.items_with('P105', match.group('rank'))):
+            bindings.append({'value': literal_binding(value), 'item': uri_binding(q_code)})
+    return bindings
+
+
+@sparql_handler(r'SELECT \?item \?(?P<variable>\w+) WHERE \{\s*\?item wdt:(?P<property>P\d+) \?(?P=variable);\s*'
+                r'wdt:P105 wd:(?P<rank>Q\d+)\.\s*\}')
+def property_index(world: StandinWorld, match, query: str) -> List[Dict[str, Any]]:
+    property_id = match.group('property')
+    ranked = world.items_with('P105', match.group('rank'))
+
+    bindings = []
+    for (indexed_property_id, value), q_codes in world.index.items():
+        if indexed_property_id == property_id:
+            for q_code in q_codes & ranked:
+                bindings.append({'item': uri_binding(q_code), match.group('variable'): literal_binding(value)})
+    bindings.sort(key=lambda binding: (binding[match.group('variable')]['value'], binding['item']['value']))
+    return paginate(bindings, query)
+
+
+@sparql_handler(r'SELECT \?item \?name \?rank WHERE \{\s*VALUES \?rank \{(?P<ranks>[^}]*)\}\s*'
+                r'\?item wdt:(?P<property>P\d+) \?\w+;\s*wdt:P225 \?name;\s*wdt:P105 \?rank\.\s*\}')
+def taxa_export(world: StandinWorld, match, query: str) -> List[Dict[str, Any]]:
+    property_id = match.group('property')
+    with_property = {q_code for (indexed_property_id, value), q_codes in world.index.items()
+                     if indexed_property_id == property_id for q_code in q_codes}
+
+    bindings = []
+    for rank in re.findall(r'wd:(Q\d+)', match.group('ranks')):
+        for q_code in world.items_with('P105', rank) & with_property:
+            for claim in truthy_claims(world.entities[q_code], 'P225'):
+                bindings.append({'item': uri_binding(q_code), 'name': literal_binding(snak_value(claim['mainsnak'])), 'rank': uri_binding(rank)})
+    bindings.sort(key=lambda binding: (binding['item']['value'], binding['name']['value']))
+    return paginate(bindings, query)
+
+
+@sparql_handler(r'SELECT \?item \?(?P<variable>\w+) WHERE \{\s*\?item wdt:(?P<filter_property>P\d+) \?\w+;\s*'
+                r'p:(?P<property>P\d+) \?statement\.\s*\?statement ps:(?P=property) \?(?P=variable);\s*'
+                r'prov:wasDerivedFrom/pr:(?P<reference_property>P\d+) wd:(?P<reference_value>Q\d+)\.\s*\}')
+def sourced_claims(world: StandinWorld, match, query: str) -> List[Dict[str, Any]]:
+    filtered = {q_code for (indexed_property_id, value), q_codes in world.index.items()
+                if indexed_property_id == match.group('filter_property') for q_code in q_codes}
+
+    bindings = []
+    with world.lock:
+        for q_code in filtered:
+            for claim in world.entities[q_code]['claims'].get(match.group('property'), []):
+                value = snak_value(claim['mainsnak'])
+                sourced = any(snak_value(snak) == match.group('reference_value')
+                              for reference in claim.get('references', [])
+                              for snak in reference['snaks'].get(match.group('reference_property'), []))
+                if value is not None and sourced:
+                    bindings.append({'item': uri_binding(q_code), match.group('variable'): uri_binding(value)})
+    bindings.sort(key=lambda binding: (binding['item']['value'], binding[match.group('variable')]['value']))
+    return paginate(bindings, query)
+
+
+@sparql_handler(r'SELECT \?item \?kingdom \?parent_name \?in_kingdom \?duplicate WHERE \{\s*VALUES \(\?item \?kingdom\) \{(?P<values>[^}]*)\}'
+                r'.*wdt:P31 \?marker\. FILTER\(\?marker IN \((?P<markers>[^)]*)\)\)')
+def candidates_context(world: StandinWorld, match, query: str) -> List[Dict[str, Any]]:
+    markers = set(re.findall(r'wd:(Q\d+)', match.group('markers')))
+
+    def values(q_code: str, property_id: str) -> List[str]:
+        entity = world.entities.get(q_code)
+        return [snak_value(claim['mainsnak']) for claim in truthy_claims(entity, property_id)] if entity else []
+
+    bindings = []
+    with world.lock:
+        for q_code, kingdom in re.findall(r'\(wd:(Q\d+) wd:(Q\d+)\)', match.group('values')):
+            # wdt:P171* (zero or more parent taxon steps)
+            ancestors = {q_code}
+            to_visit = [q_code]
+            while to_visit:
+                for parent in values(to_visit.pop(), 'P171'):
+                    if parent is not None and parent not in ancestors:
+                        ancestors.add(parent)
+                        to_visit.append(parent)
+
+            row = {'item': uri_binding(q_code), 'kingdom': uri_binding(kingdom),
+                   'in_kingdom': boolean_binding(kingdom in ancestors),
+                   'duplicate': boolean_binding(bool(markers & set(values(q_code, 'P31'))))}
+            parent_names = [name for parent in values(q_code, 'P171') if parent for name in values(parent, 'P225')]
+            for parent_name in parent_names:
+                bindings.append(dict(row, parent_name=literal_binding(parent_name)))
+            if not parent_names:
+                bindings.append(row)
+    return bindings
+
+
+class RateLimiter(object):
+    # Fixed window rate limiter: at most max_requests per second
+
+    def __init__(self, max_requests: Optional[float]):
+        self.max_requests = max_requests
+        self.window_start = time.monotonic()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if not self.max_requests:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.count = 0
+            self.count = self.count + 1
+            return self.count <= self.max_requests
+
+
+class StandinRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'StandinServer/1.0'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, data: Any, status: int = 200, headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def service(self, path: str) -> Optional[str]:
+        if path.startswith(CATALOGUE_PATH):
+            return 'catalogue'
+        elif path == SPARQL_PATH:
+            return 'sparql'
+        elif path == API_PATH:
+            return 'api'
+        return None
+
+    def handle_request(self, params: Dict[str, str]):
+        server = self.server  # type: StandinServer
+        path = urlparse(self.path).path
+
+        if path == STATS_PATH:
+            return self.send_json(server.stats())
+
+        service = self.service(path)
+        if service is None:
+            return self.send_json({'error': 'Not found'}, status=404)
+
+        server.count_request(service)
+        if not server.rate_limiters[service].allow():
+            server.count_request(f'{service}_throttled')
+            return self.send_json({'error': 'Too many requests'}, status=429, headers={'Retry-After': '1'})
+
+        time.sleep(server.latencies.get(service, 0))
+
+        if service == 'catalogue':
+            self.handle_catalogue(int(params.get('page', 1)))
+        elif service == 'sparql':
+            self.handle_sparql(params.get('query', ''))
+        else:
+            self.handle_api(params)
+
+    def handle_catalogue(self, page_num: int):
+        # Pages carry an ETag, and conditional requests (If-None-Match) are supported
+        page = self.server.world.catalogue_page(page_num)
+        etag = '"' + hashlib.sha1(json.dumps(page, sort_keys=True).encode('utf-8')).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_json(page, headers={'ETag': etag})
+
+    def handle_sparql(self, query: str):
+        for pattern, handler in SPARQL_HANDLERS:
+            match = pattern.search(query)
+            if match:
+                bindings = handler(self.server.world, match, query)
+                return self.send_json({'head': {'vars': []}, 'results': {'bindings': bindings}})
+        self.send_json({'error': f'Query not understood by the stand-in server: {query}'}, status=400)
+
+    def handle_api(self, params: Dict[str, str]):
+        world = self.server.world
+        action = params.get('action')
+        if action == 'wbgetentities':
+            ids = [q_code for q_code in params.get('ids', '').split('|') if q_code]
+            props = params.get('props', 'info|sitelinks|aliases|labels|descriptions|claims|datatype').split('|')
+            self.send_json(world.get_entities(ids, props))
+        elif action == 'wbeditentity':
+            # Edits over the edit rate limit are refused as MediaWiki does when the replication lag is above the
+            # maxlag parameter: HTTP 200, a "maxlag" error and a Retry-After header
+            if params.get('maxlag') and not self.server.edits_rate_limiter.allow():
+                self.server.count_request('edits_maxlag')
+                lag = float(params['maxlag']) + 1
+                return self.send_json({'error': {'code': 'maxlag', 'info': f'Waiting for a database server: {lag} seconds lagged.', 'lag': lag}},
+                                      headers={'Retry-After': '1', 'X-Database-Lag': str(lag)})
+            self.server.count_request('edits')
+            self.send_json(world.edit_entity(params['id'], json.loads(params.get('data', '{}'))))
+        else:
+            self.send_json({'error': {'code': 'badvalue', 'info': f'Unsupported action: {action}'}})
+
+    def do_GET(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        self.handle_request(params)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        params.update({key: values[0] for key, values in parse_qs(body).items()})
+        self.handle_request(params)
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, world: StandinWorld, host: str = '127.0.0.1', port: int = 0,
+                 latencies: Optional[Dict[str, float]] = None, rate_limits: Optional[Dict[str, float]] = None,
+                 edit_rate_limit: Optional[float] = None):
+        super().__init__((host, port), StandinRequestHandler)
+        self.world = world
+        self.latencies = latencies or {}
+        self.rate_limiters = {service: RateLimiter((rate_limits or {}).get(service)) for service in ('catalogue', 'sparql', 'api')}
+        self.edits_rate_limiter = RateLimiter(edit_rate_limit)
+        self.request_counts = {}  # type: Dict[str, int]
+        self.counts_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def count_request(self, name: str):
+        with self.counts_lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.counts_lock:
+            return dict(self.request_counts)
+
+    def start_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, name='standin-server', daemon=True)
+        thread.start()
+        return thread
+
+
+def load_world(catalogue_path: str, entities_path: str, catalogue_page_size: int = 100) -> StandinWorld:
+    with open(catalogue_path) as catalogue_file:
+        catalogue = json.load(catalogue_file)
+    with open(entities_path) as entities_file:
+        entities = json.load(entities_file)
+    if isinstance(entities, list):
+        entities = {entity['id']: entity for entity in entities}
+    return StandinWorld(catalogue, entities, catalogue_page_size=catalogue_page_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the catalogue, SPARQL and Wikibase API endpoints.")
+    parser.add_argument('--catalogue', required=True, help="JSON file: list of catalogue species (as in all_species_details_json)")
+    parser.add_argument('--entities', required=True, help="JSON file: Wikidata entities (wbgetentities format), by Q identifier")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--page-size', type=int, default=100, help="Number of species per catalogue page")
+    for service in ('catalogue', 'sparql', 'api'):
+        parser.add_argument(f'--{service}-latency', type=float, default=0, help=f"Latency added to each {service} request (seconds)")
+        parser.add_argument(f'--{service}-rate-limit', type=float, default=None, help=f"Maximum number of {service} requests per second")
+    parser.add_argument('--edit-rate-limit', type=float, default=None,
+                        help="Maximum number of edits per second, above which edits sent with maxlag get a maxlag error")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = StandinServer(load_world(args.catalogue, args.entities, args.page_size), host=args.host, port=args.port,
+                           latencies={'catalogue': args.catalogue_latency, 'sparql': args.sparql_latency, 'api': args.api_latency},
+                           rate_limits={'catalogue': args.catalogue_rate_limit, 'sparql': args.sparql_rate_limit, 'api': args.api_rate_limit},
+                           edit_rate_limit=args.edit_rate_limit)
+    logger.info(f"Stand-in server listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8  -*-
+from typing import Dict, List, Optional, Set, Tuple
+
+PARENT_TAXON_PROPERTY_ID = 'P171'
+TAXON_NAME_PROPERTY_ID = 'P225'
+INSTANCE_OF_PROPERTY_ID = 'P31'
+
+ANIMALIA_Q_VALUE = 'Q729'
+PLANTAE_Q_VALUE = 'Q756'
+KINGDOM_NAMES = {ANIMALIA_Q_VALUE: 'Animalia', PLANTAE_Q_VALUE: 'Plantae'}
+
+# "Instance of" values of the items that aren't real taxa: duplicates waiting to be merged, disambiguation pages
+DUPLICATE_MARKERS = ('Q17362920',  # Wikimedia duplicated page
+                     'Q4167410')  # Wikimedia disambiguation page
+
+
+class CandidateContext(object):
+    # What we know about a candidate item to tell it apart from the others
+    __slots__ = ('parent_names', 'in_kingdom', 'duplicate')
+
+    def __init__(self):
+        self.parent_names = set()  # type: Set[str]
+        self.in_kingdom = False
+        self.duplicate = False
+
+
+def candidates_context_query(candidates: List[Tuple[str, str]]) -> str:
+    # candidates: (Q code, expected kingdom Q code). One row per parent taxon name of each candidate.
+    values_str = ' '.join(f'(wd:{q_code} wd:{kingdom})' for q_code, kingdom in candidates)
+    markers_str = ', '.join(f'wd:{marker}' for marker in DUPLICATE_MARKERS)
+    return f'''SELECT ?item ?kingdom ?parent_name ?in_kingdom ?duplicate WHERE {{
+        VALUES (?item ?kingdom) {{ {values_str} }}
+        OPTIONAL {{ ?item wdt:{PARENT_TAXON_PROPERTY_ID}/wdt:{TAXON_NAME_PROPERTY_ID} ?parent_name. }}
+        BIND(EXISTS {{ ?item wdt:{PARENT_TAXON_PROPERTY_ID}* ?kingdom. }} AS ?in_kingdom)
+        BIND(EXISTS {{ ?item wdt:{INSTANCE_OF_PROPERTY_ID} ?marker. FILTER(?marker IN ({markers_str})) }} AS ?duplicate)
+        }}'''
+
+
+def parse_candidates_context(bindings: List[Dict]) -> Dict[Tuple[str, str], CandidateContext]:
+    # (Q code, kingdom Q code) -> context
+    contexts = {}  # type: Dict[Tuple[str, str], CandidateContext]
+    for binding in bindings:
+        key = (binding['item']['value'].rsplit('/', 1)[-1], binding['kingdom']['value'].rsplit('/', 1)[-1])
+        context = contexts.setdefault(key, CandidateContext())
+        if 'parent_name' in binding:
+            context.parent_names.add(binding['parent_name']['value'])
+        context.in_kingdom = binding['in_kingdom']['value'] == 'true'
+        context.duplicate = binding['duplicate']['value'] == 'true'
+    return contexts
+
+
+def genus_name(species_name: str) -> Optional[str]:
+    parts = species_name.split()
+    return parts[0] if parts else None
+
+
+def choose_candidate(candidates: List[str], contexts: Dict[str, CandidateContext], kingdom: str,
+                     parent_name: Optional[str]) -> Tuple[Optional[str], str]:
+    # Narrow the candidates down with each criterion in turn (a criterion that would exclude all of them is
+    # ignored). Returns the chosen Q code (None if several are left) and the rationale of the choice.
+    remaining = list(candidates)
+    rationale = []
+
+    criteria = [('marked as duplicate or disambiguation page', lambda context: not context.duplicate),
+                (f'not in {KINGDOM_NAMES.get(kingdom, kingdom)}', lambda context: context.in_kingdom)]
+    if parent_name:
+        criteria.append((f'parent taxon is not {parent_name}', lambda context: parent_name in context.parent_names))
+
+    for reason, keep in criteria:
+        kept = [q_code for q_code in remaining if q_code in contexts and keep(contexts[q_code])]
+        if kept and len(kept) < len(remaining):
+            excluded = [q_code for q_code in remaining if q_code not in kept]
+            rationale.append(f"{', '.join(excluded)} {reason}")
+            remaining = kept
+        if len(remaining) == 1:
+            break
+
+    if len(remaining) == 1:
+        return remaining[0], '; '.join(rationale)
+    return None, '; '.join(rationale + [f"can't tell {', '.join(remaining)} apart"])
@@ -0,0 +1,86 @@
+# -*- coding: utf-8  -*-
+import json
+import unittest
+
+from catalogue_stream import CataloguePageParser, IncompleteJson
+
+PAGE = {'page': 12,
+        'results': [{'id': 12345,
+                     'name': 'Zygæna filipendulæ',
+                     'is_synonym': False,
+                     'observations': [{'observationType': 'HostPlantSpecies', 'name': 'Lotus corniculatus'},
+                                      {'observationType': 'HostPlantGenus', 'name': 'Trifolium'}]},
+                    {'id': 7,
+                     'name': 'Tricky "name", with [brackets] and {braces}',
+                     'is_synonym': True,
+                     'observations': [{'observationType': 'HostPlantSpecies', 'name': 'Épilobe 🌱 × hybride'},
+                                      {'observationType': 'Other', 'name': 'ignored'}]},
+                    {'id': 890,
+                     'name': 'Lepidopterus tertius',
+                     'is_synonym': False,
+                     'observations': []}],
+        'hasMoreResults': True}
+
+
+def chunked(data: bytes, *boundaries: int):
+    previous = 0
+    for boundary in boundaries:
+        yield data[previous:boundary]
+        previous = boundary
+    yield data[previous:]
+
+
+def records_summary(records):
+    return [(record.id, record.name, record.is_synonym, record.host_plant_species, record.host_plant_genera)
+            for record in records]
+
+
+class CataloguePageParserTest(unittest.TestCase):
+    def setUp(self):
+        self.data = json.dumps(PAGE, ensure_ascii=False, indent=1).encode('utf-8')
+        self.expected = [(12345, 'Zygæna filipendulæ', False, ('Lotus corniculatus',), ('Trifolium',)),
+                         (7, 'Tricky "name", with [brackets] and {braces}', True, ('Épilobe 🌱 × hybride',), ()),
+                         (890, 'Lepidopterus tertius', False, (), ())]
+
+    def check(self, chunks):
+        parser = CataloguePageParser(chunks)
+        self.assertEqual(records_summary(parser), self.expected)
+        self.assertEqual(parser.metadata, {'page': 12, 'hasMoreResults': True})
+
+    def test_single_chunk(self):
+        self.check([self.data])
+
+    def test_every_boundary(self):
+        # Cuts inside keys, strings, numbers and multi-byte UTF-8 sequences
+        for boundary in range(len(self.data) + 1):
+            with self.subTest(boundary=boundary):
+                self.check(chunked(self.data, boundary))
+
+    def test_one_byte_chunks(self):
+        self.check(self.data[index:index + 1] for index in range(len(self.data)))
+
+    def test_number_at_chunk_end(self):
+        # "12345" split after "123": the number must not be read as 123
+        boundary = self.data.index(b'12345') + 3
+        self.check(chunked(self.data, boundary))
+
+    def test_number_at_end_of_page(self):
+        data = b'{"results": [], "page": 42}'
+        parser = CataloguePageParser(chunked(data, len(data) - 2))
+        self.assertEqual(list(parser), [])
+        self.assertEqual(parser.metadata, {'page': 42})
+
+    def test_empty_page(self):
+        self.assertEqual(list(CataloguePageParser([b' { } '])), [])
+
+    def test_truncated_page(self):
+        with self.assertRaises(IncompleteJson):
+            list(CataloguePageParser(chunked(self.data[:len(self.data) // 2], 10)))
+
+    def test_unexpected_character(self):
+        with self.assertRaises(ValueError):
+            list(CataloguePageParser([b'["not", "a page"]']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8  -*-
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from http_client import HttpClient, HttpStatusError, parse_retry_after
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    # Answers with the next status of the server script (the last one is repeated)
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self):
+        server = self.server
+        with server.lock:
+            status = server.statuses[min(server.requests, len(server.statuses) - 1)]
+            server.requests = server.requests + 1
+        body = json.dumps({'status': status}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.respond()
+
+
+class HttpClientStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ScriptedHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.client = HttpClient(max_status_retries=3)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def script(self, *statuses: int):
+        self.server.statuses = statuses
+        self.server.requests = 0
+
+    def test_throttled_get_retried(self):
+        self.script(429, 503, 200)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_retries_exhausted(self):
+        self.script(503)
+        with self.assertRaises(HttpStatusError) as raised:
+            self.client.get(self.url)
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertEqual(self.server.requests, 4)
+
+    def test_client_error_not_retried(self):
+        self.script(404)
+        with self.assertRaises(HttpStatusError):
+            self.client.get(self.url)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_post_not_retried(self):
+        self.script(503, 200)
+        with self.assertRaises(HttpStatusError):
+            self.client.post(self.url, data={'action': 'wbeditentity'})
+        self.assertEqual(self.server.requests, 1)
+
+    def test_unchecked_status(self):
+        # For the callers with their own retry policy
+        self.script(429, 200)
+        self.assertEqual(self.client.get(self.url, check_status=False).status_code, 429)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_not_modified(self):
+        self.script(304)
+        self.assertEqual(self.client.get(self.url).status_code, 304)
+
+
+class ParseRetryAfterTest(unittest.TestCase):
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('5'), 5.0)
+        self.assertEqual(parse_retry_after('-1'), 0.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)  # In the past
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8  -*-
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from lookup_cache import DAY, LookupCache
+
+NOW = 1700000000.0
+
+
+class LookupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.now = NOW
+        patcher = mock.patch('lookup_cache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = self.new_cache()
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def new_cache(self, **options) -> LookupCache:
+        return LookupCache(os.path.join(self.directory.name, 'lookup_cache.sqlite3'), **options)
+
+    def test_round_trip(self):
+        self.cache.put_many('species', {'Quercus robur': ['Q1'], 'Nonexistus': [], 'Dubius': ['Q2', 'Q3']})
+        self.assertEqual(self.cache.get_many('species', ['Quercus robur', 'Nonexistus', 'Dubius', 'Unknown']),
+                         {'Quercus robur': ['Q1'], 'Nonexistus': [], 'Dubius': ['Q2', 'Q3']})
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 1))
+        # Keyed by (lookup kind, value)
+        self.assertEqual(self.cache.get_many('genus', ['Quercus robur']), {})
+
+    def test_survives_between_runs(self):
+        self.cache.put_many('species', {'Quercus robur': ['Q1']})
+        self.cache.close()
+        self.cache = self.new_cache()
+        self.assertEqual(self.cache.get_many('species', ['Quercus robur']), {'Quercus robur': ['Q1']})
+
+    def test_ttl_per_outcome(self):
+        self.cache.close()
+        self.cache = self.new_cache(found_ttl=30 * DAY, not_found_ttl=7 * DAY, multiple_ttl=2 * DAY)
+        self.cache.put_many('species', {'Found': ['Q1'], 'Not found': [], 'Multiple': ['Q2', 'Q3']})
+        values = ['Found', 'Not found', 'Multiple']
+
+        self.now = NOW + 2 * DAY
+        self.assertEqual(set(self.cache.get_many('species', values)), {'Found', 'Not found', 'Multiple'})
+        self.now = NOW + 2 * DAY + 1
+        self.assertEqual(set(self.cache.get_many('species', values)), {'Found', 'Not found'})
+        self.now = NOW + 7 * DAY + 1
+        self.assertEqual(set(self.cache.get_many('species', values)), {'Found'})
+        self.now = NOW + 30 * DAY + 1
+        self.assertEqual(self.cache.get_many('species', values), {})
+
+    def test_use_doesnt_extend_ttl(self):
+        self.cache.put_many('species', {'Nonexistus': []})
+        self.now = NOW + 6 * DAY
+        self.assertEqual(self.cache.get_many('species', ['Nonexistus']), {'Nonexistus': []})
+        self.now = NOW + 7 * DAY + 1
+        self.assertEqual(self.cache.get_many('species', ['Nonexistus']), {})
+
+    def test_put_refreshes_entry(self):
+        self.cache.put_many('species', {'Nonexistus': []})
+        self.now = NOW + 7 * DAY + 1
+        self.cache.put_many('species', {'Nonexistus': ['Q1']})
+        self.assertEqual(self.cache.get_many('species', ['Nonexistus']), {'Nonexistus': ['Q1']})
+
+    def test_least_recently_used_evicted(self):
+        self.cache.close()
+        self.cache = self.new_cache(max_entries=3)
+        for index, value in enumerate(['A', 'B', 'C']):
+            self.now = NOW + index
+            self.cache.put_many('species', {value: ['Q1']})
+
+        self.now = NOW + 10
+        self.cache.get_many('species', ['A'])  # B is now the least recently used
+        self.now = NOW + 11
+        self.cache.put_many('species', {'D': ['Q2']})
+
+        self.now = NOW + 12
+        self.assertEqual(set(self.cache.get_many('species', ['A', 'B', 'C', 'D'])), {'A', 'C', 'D'})
+
+    def test_eviction_down_to_max_entries(self):
+        self.cache.close()
+        self.cache = self.new_cache(max_entries=5)
+        self.cache.put_many('species', {f'Species {index}': ['Q1'] for index in range(8)})
+        count = self.cache.connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+        self.assertEqual(count, 5)
+
+    def test_disambiguations(self):
+        self.cache.put_disambiguations('species', {'Dubius': (['Q3', 'Q2'], 'Q2', 'Q3 not in Animalia'),
+                                                   'Incertus': (['Q4', 'Q5'], None, "can't tell Q4, Q5 apart")})
+        self.assertEqual(self.cache.get_disambiguations('species', {'Dubius': ['Q2', 'Q3'], 'Incertus': ['Q4', 'Q5']}),
+                         {'Dubius': ('Q2', 'Q3 not in Animalia'), 'Incertus': (None, "can't tell Q4, Q5 apart")})
+        # Only valid as long as the lookup returns the same candidates
+        self.assertEqual(self.cache.get_disambiguations('species', {'Dubius': ['Q2', 'Q3', 'Q6']}), {})
+        # Undecided ones expire with the multiple matches, decided ones with the found ones
+        self.now = NOW + 7 * DAY + 1
+        self.assertEqual(self.cache.get_disambiguations('species', {'Dubius': ['Q2', 'Q3'], 'Incertus': ['Q4', 'Q5']}),
+                         {'Dubius': ('Q2', 'Q3 not in Animalia')})
+
+
+if __name__ == '__main__':
+    unittest.main()
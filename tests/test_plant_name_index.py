@@ -0,0 +1,62 @@
+# -*- coding: utf-8  -*-
+import unittest
+
+from plant_name_index import normalized_name, similarity
+
+
+class NormalizedNameTest(unittest.TestCase):
+    def check(self, cases):
+        for name, expected in cases:
+            with self.subTest(name=name):
+                self.assertEqual(normalized_name(name), expected)
+
+    def test_plain_names(self):
+        self.check([('Quercus robur', 'quercus robur'),
+                    ('Trifolium', 'trifolium'),
+                    ('  Quercus   robur ', 'quercus robur'),
+                    ('Quercus\u00a0robur', 'quercus robur')])  # NFKC: no-break space
+
+    def test_authorship(self):
+        self.check([('Quercus robur L.', 'quercus robur'),
+                    ('Quercus robur (L.) Mill.', 'quercus robur'),
+                    ('Salix caprea Ehrh. ex Willd.', 'salix caprea'),
+                    ('Pinus sylvestris L., 1753', 'pinus sylvestris'),
+                    ('Betula pendula ssp. mandshurica (Regel) Ashburner', 'betula pendula subsp. mandshurica')])
+
+    def test_hybrid_signs(self):
+        self.check([('Salix × rubens', 'salix rubens'),
+                    ('Salix x rubens', 'salix rubens'),
+                    ('Mentha ×piperita', 'mentha piperita'),
+                    ('Mentha ✕ piperita', 'mentha piperita'),
+                    ('Mentha ⨯ piperita', 'mentha piperita'),
+                    ('× Crataemespilus grandiflora', 'crataemespilus grandiflora')])
+
+    def test_qualifiers(self):
+        self.check([('Rubus fruticosus agg.', 'rubus fruticosus'),
+                    ('Rubus fruticosus L. agg.', 'rubus fruticosus'),
+                    ('Rubus fruticosus aggr.', 'rubus fruticosus'),
+                    ('Rubus fruticosus s.l.', 'rubus fruticosus'),
+                    ('Taraxacum officinale sensu lato', 'taraxacum officinale'),
+                    ('Quercus sp.', 'quercus'),
+                    ('Salix spp.', 'salix')])
+
+    def test_infraspecific_ranks(self):
+        self.check([('Betula pendula subsp. mandshurica', 'betula pendula subsp. mandshurica'),
+                    ('Betula pendula ssp. mandshurica', 'betula pendula subsp. mandshurica'),
+                    ('Vicia cracca L. var. tenuifolia', 'vicia cracca var. tenuifolia'),
+                    ('Rosa canina forma dumalis', 'rosa canina f. dumalis')])
+
+    def test_catalogue_and_wikidata_spellings_meet(self):
+        self.assertEqual(normalized_name('Rubus fruticosus L. agg.'), normalized_name('Rubus fruticosus'))
+        self.assertEqual(normalized_name('Salix x rubens Schrank'), normalized_name('Salix × rubens'))
+
+
+class SimilarityTest(unittest.TestCase):
+    def test_similarity(self):
+        self.assertEqual(similarity('quercus robur', 'quercus robur'), 1.0)
+        self.assertEqual(similarity('', ''), 1.0)
+        self.assertAlmostEqual(similarity('quercus robur', 'quercus rubur'), 1 - 1 / 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
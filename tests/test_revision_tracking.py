@@ -0,0 +1,109 @@
+# -*- coding: utf-8  -*-
+# End-to-end checks of --incremental --track-revisions / --recent-changes: the bot runs in a subprocess against an
+# in-process stand-in server (as in benchmark.py), and we record which items it reads.
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from typing import List, Set
+
+from benchmark import BOT_PATH, WorldGenerator
+from standin_server import StandinServer, StandinWorld
+
+HOST_PROPERTY_ID = 'P2975'
+BOT_TIMEOUT = 120  # seconds
+
+
+class RecordingWorld(StandinWorld):
+    # Remembers the items whose claims were read (revision checks only ask for 'info')
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_items = set()  # type: Set[str]
+        self.revision_checks = 0
+
+    def get_entities(self, q_codes: List[str], props: List[str]):
+        if 'claims' in props:
+            self.read_items.update(q_codes)
+        else:
+            self.revision_checks = self.revision_checks + len(q_codes)
+        return super().get_entities(q_codes, props)
+
+
+class RevisionTrackingTest(unittest.TestCase):
+    def setUp(self):
+        # Every lepidoptera and plant found exactly once: all the items with host plants get edited by the first run
+        catalogue, entities = WorldGenerator(60, match_rate=1, duplicate_rate=0, plant_match_rate=1,
+                                             plant_duplicate_rate=0, seed=1).generate()
+        self.world = RecordingWorld(catalogue, entities, catalogue_page_size=20)
+        self.server = StandinServer(self.world)
+        self.server.start_in_thread()
+        self.work_dir = tempfile.TemporaryDirectory(prefix='revision-tracking-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.work_dir.cleanup()
+
+    def run_bot(self, *options: str):
+        self.world.read_items = set()
+        self.world.revision_checks = 0
+        process = subprocess.run([sys.executable, BOT_PATH, 'run', '--standin', self.server.url, '--incremental'] + list(options),
+                                 cwd=self.work_dir.name, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=BOT_TIMEOUT)
+        self.assertEqual(process.returncode, 0, process.stdout.decode('utf-8', 'replace')[-3000:])
+
+    def synchronized_items(self) -> List[str]:
+        return sorted(q_code for q_code, entity in self.world.entities.items() if entity['claims'].get(HOST_PROPERTY_ID))
+
+    def edit_on_server(self, q_code: str) -> int:
+        # Someone else edits the item (a new revision, nothing the bot cares about)
+        return self.world.edit_entity(q_code, {'claims': []})['entity']['lastrevid']
+
+    def test_track_revisions(self):
+        self.run_bot('--track-revisions')
+        synchronized = self.synchronized_items()
+        self.assertTrue(synchronized)
+        self.assertTrue(set(synchronized) <= self.world.read_items)
+
+        # Nothing changed: the revisions are checked, no item is read again
+        self.run_bot('--track-revisions')
+        self.assertEqual(self.world.read_items, set())
+        self.assertEqual(self.world.revision_checks, len(synchronized))
+
+        edited = synchronized[len(synchronized) // 2]
+        self.edit_on_server(edited)
+        self.run_bot('--track-revisions')
+        self.assertEqual(self.world.read_items, {edited})
+
+    def test_unresolved_host_plants(self):
+        # An item none of whose host plants are found @Wikidata is neither read nor tracked
+        species = next(species for species in self.world.catalogue if species['observations'])
+        species['observations'] = [{'observationType': 'HostPlantSpecies', 'name': 'Nonexistus plantus'}]
+
+        self.run_bot('--track-revisions')
+        synchronized = self.synchronized_items()
+        self.run_bot('--track-revisions')
+        self.assertEqual(self.world.read_items, set())
+        self.assertEqual(self.world.revision_checks, len(synchronized))
+
+    def test_recent_changes(self):
+        self.run_bot('--track-revisions')
+        synchronized = self.synchronized_items()
+
+        edited = synchronized[0]
+        revision = self.edit_on_server(edited)
+        feed_path = os.path.join(self.work_dir.name, 'recent_changes.jsonl')
+        with open(feed_path, 'w') as feed_file:
+            # An entry of the recentchanges API and an event of the EventStreams recentchange stream
+            feed_file.write(json.dumps({'type': 'edit', 'title': edited, 'revid': revision - 1, 'old_revid': revision - 2}) + '\n')
+            feed_file.write(json.dumps({'type': 'edit', 'title': edited, 'revision': {'old': revision - 1, 'new': revision}}) + '\n')
+
+        # The revisions come from the feed: no revision checks, and only the edited item is read again
+        self.run_bot('--recent-changes', feed_path)
+        self.assertEqual(self.world.read_items, {edited})
+        self.assertEqual(self.world.revision_checks, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
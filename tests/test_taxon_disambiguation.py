@@ -0,0 +1,99 @@
+# -*- coding: utf-8  -*-
+import unittest
+
+from taxon_disambiguation import (ANIMALIA_Q_VALUE, PLANTAE_Q_VALUE, CandidateContext, choose_candidate, genus_name,
+                                  parse_candidates_context)
+
+
+def context(parent_names=(), in_kingdom=True, duplicate=False) -> CandidateContext:
+    candidate_context = CandidateContext()
+    candidate_context.parent_names = set(parent_names)
+    candidate_context.in_kingdom = in_kingdom
+    candidate_context.duplicate = duplicate
+    return candidate_context
+
+
+class ChooseCandidateTest(unittest.TestCase):
+    def test_duplicate_excluded(self):
+        contexts = {'Q1': context(duplicate=True), 'Q2': context()}
+        chosen, rationale = choose_candidate(['Q1', 'Q2'], contexts, ANIMALIA_Q_VALUE, None)
+        self.assertEqual(chosen, 'Q2')
+        self.assertEqual(rationale, 'Q1 marked as duplicate or disambiguation page')
+
+    def test_kingdom(self):
+        # A plant and a moth sharing the same name
+        contexts = {'Q1': context(in_kingdom=False), 'Q2': context()}
+        chosen, rationale = choose_candidate(['Q1', 'Q2'], contexts, ANIMALIA_Q_VALUE, None)
+        self.assertEqual(chosen, 'Q2')
+        self.assertEqual(rationale, 'Q1 not in Animalia')
+
+        contexts = {'Q1': context(), 'Q2': context(in_kingdom=False)}
+        self.assertEqual(choose_candidate(['Q1', 'Q2'], contexts, PLANTAE_Q_VALUE, None)[0], 'Q1')
+
+    def test_parent_name(self):
+        contexts = {'Q1': context(parent_names={'Zygaena'}), 'Q2': context(parent_names={'Agrumenia'})}
+        chosen, rationale = choose_candidate(['Q1', 'Q2'], contexts, ANIMALIA_Q_VALUE, 'Zygaena')
+        self.assertEqual(chosen, 'Q1')
+        self.assertEqual(rationale, 'Q2 parent taxon is not Zygaena')
+
+    def test_criteria_in_turn(self):
+        contexts = {'Q1': context(duplicate=True, parent_names={'Zygaena'}),
+                    'Q2': context(in_kingdom=False, parent_names={'Zygaena'}),
+                    'Q3': context(parent_names={'Agrumenia'}),
+                    'Q4': context(parent_names={'Zygaena'})}
+        chosen, rationale = choose_candidate(['Q1', 'Q2', 'Q3', 'Q4'], contexts, ANIMALIA_Q_VALUE, 'Zygaena')
+        self.assertEqual(chosen, 'Q4')
+        self.assertEqual(rationale, 'Q1 marked as duplicate or disambiguation page; Q2 not in Animalia; '
+                                    'Q3 parent taxon is not Zygaena')
+
+    def test_criterion_excluding_all_ignored(self):
+        # None of them is in the expected kingdom (incomplete taxonomy): the criterion doesn't help, but doesn't
+        # exclude them either
+        contexts = {'Q1': context(in_kingdom=False, parent_names={'Agrumenia'}),
+                    'Q2': context(in_kingdom=False, parent_names={'Zygaena'})}
+        chosen, rationale = choose_candidate(['Q1', 'Q2'], contexts, ANIMALIA_Q_VALUE, 'Zygaena')
+        self.assertEqual(chosen, 'Q2')
+        self.assertEqual(rationale, 'Q1 parent taxon is not Zygaena')
+
+    def test_undecided(self):
+        contexts = {'Q1': context(parent_names={'Zygaena'}), 'Q2': context(parent_names={'Zygaena'})}
+        chosen, rationale = choose_candidate(['Q1', 'Q2'], contexts, ANIMALIA_Q_VALUE, 'Zygaena')
+        self.assertIsNone(chosen)
+        self.assertEqual(rationale, "can't tell Q1, Q2 apart")
+
+    def test_undecided_without_parent_name(self):
+        contexts = {'Q1': context(parent_names={'Zygaena'}), 'Q2': context(parent_names={'Agrumenia'})}
+        self.assertIsNone(choose_candidate(['Q1', 'Q2'], contexts, ANIMALIA_Q_VALUE, None)[0])
+
+    def test_candidate_without_context(self):
+        # A candidate the context query didn't return can't be chosen by any criterion
+        contexts = {'Q2': context()}
+        self.assertEqual(choose_candidate(['Q1', 'Q2'], contexts, ANIMALIA_Q_VALUE, None)[0], 'Q2')
+
+
+class ParseCandidatesContextTest(unittest.TestCase):
+    def test_parse(self):
+        def binding(item, parent_name=None, in_kingdom='true', duplicate='false'):
+            row = {'item': {'value': f'http://www.wikidata.org/entity/{item}'},
+                   'kingdom': {'value': f'http://www.wikidata.org/entity/{ANIMALIA_Q_VALUE}'},
+                   'in_kingdom': {'value': in_kingdom},
+                   'duplicate': {'value': duplicate}}
+            if parent_name is not None:
+                row['parent_name'] = {'value': parent_name}
+            return row
+
+        contexts = parse_candidates_context([binding('Q1', 'Zygaena'), binding('Q1', 'Zygaeninae'),
+                                             binding('Q2', in_kingdom='false', duplicate='true')])
+        self.assertEqual(contexts[('Q1', ANIMALIA_Q_VALUE)].parent_names, {'Zygaena', 'Zygaeninae'})
+        self.assertTrue(contexts[('Q1', ANIMALIA_Q_VALUE)].in_kingdom)
+        self.assertEqual(contexts[('Q2', ANIMALIA_Q_VALUE)].parent_names, set())
+        self.assertFalse(contexts[('Q2', ANIMALIA_Q_VALUE)].in_kingdom)
+        self.assertTrue(contexts[('Q2', ANIMALIA_Q_VALUE)].duplicate)
+
+    def test_genus_name(self):
+        self.assertEqual(genus_name('Zygaena filipendulae'), 'Zygaena')
+        self.assertIsNone(genus_name(''))
+
+
+if __name__ == '__main__':
+    unittest.main()